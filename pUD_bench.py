@@ -0,0 +1,370 @@
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+
+# Benchmark harness for plsUpdateData: builds a synthetic data repo with a local
+# bare remote, then times each verb through the CLI, through main() and as
+# direct function calls on a warm store. Results are written as JSON.
+
+PATH = os.path.dirname(os.path.realpath(__file__))
+RESULTS_VERSION = 1
+
+
+def read_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pUD_bench',
+        description='Benchmark plsUpdateData against a synthetic data repo',
+    )
+    parser.add_argument('--root', help="Directory for the synthetic repo (default: a temporary directory).", metavar="DIR")
+    parser.add_argument('--keep', help="Keep the synthetic repo after the run.", action='store_true')
+    parser.add_argument('--tokens', help="Number of token files.", type=int, default=20)
+    parser.add_argument('--graphs', help="Graphs per token.", type=int, default=2)
+    parser.add_argument('--chains', help="Chains per graph.", type=int, default=3)
+    parser.add_argument('--points', help="Datapoints per chain.", type=int, default=500)
+    parser.add_argument('--seed', help="Random seed for the generated values.", type=int, default=1)
+    parser.add_argument('--runs', help="Timed runs per verb.", type=int, default=5)
+    parser.add_argument('--modes', help="Comma separated modes to run.", default='cli,main,function')
+    parser.add_argument('--verbs', help="Comma separated verbs to run (default: all).")
+    parser.add_argument('--out', help="Write results as JSON to FILE.", metavar="FILE")
+    parser.add_argument('--compare', help="Compare medians against an earlier results FILE.", metavar="FILE")
+    parser.add_argument('--stress', help="Instead of timing verbs, let N processes add points at the same time "
+                                         "and check that none were lost.", type=int, metavar="N")
+    parser.add_argument('--stress-adds', help="Points each --stress process adds.", type=int, default=30, metavar="N")
+    if argv is None:
+        argv = sys.argv[1:]
+    return parser.parse_args(args=argv)
+
+
+def git(cwd, *args):
+    subprocess.run(['git', '-C', cwd, *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def datapoint_value(x, kind, time_format):
+    # numbers, string numbers and TIME_FORMAT timestamps, as found in the real data repo
+    if kind == 0:
+        return datetime.fromtimestamp(x).strftime(time_format)
+    if kind == 1:
+        return float(x)
+    return str(x)
+
+
+def setup_app(root):
+    # ROOT/app holds a copy of the scripts, so their status, caches and data/
+    # clone all stay inside ROOT.
+    app = root + "/app"
+    os.makedirs(app)
+    for script in ('plsUpdateData.py', 'pUD_client.py'):
+        shutil.copy(f'{PATH}/{script}', f'{app}/{script}')
+    return app
+
+
+def generate(root, app, tokens, graphs, chains, points, seed, time_format):
+    # ROOT/remote.git is the bare remote that ROOT/app/data is cloned from.
+    rng = random.Random(seed)
+    subprocess.run(['git', 'init', '-q', '--bare', root + "/remote.git"], check=True)
+    subprocess.run(['git', 'clone', '-q', root + "/remote.git", app + "/data"], check=True, stderr=subprocess.DEVNULL)
+    data = app + "/data"
+    git(data, 'config', 'user.name', 'pUD bench')
+    git(data, 'config', 'user.email', 'bench@localhost')
+    start = int(time.time()) - points * 3600
+    for t in range(tokens):
+        token = {}
+        for g in range(graphs):
+            token[f'graph{g}'] = {}
+            for c in range(chains):
+                series = []
+                y = rng.random() * 100
+                for i in range(points):
+                    y += rng.random() - 0.5
+                    yv = round(y, 6)
+                    series.append([datapoint_value(start + i * 3600, i % 3, time_format), yv if i % 2 else str(yv)])
+                token[f'graph{g}'][f'chain{c}'] = series
+        with open(f'{data}/TOK{t}.json', 'w') as f:
+            f.write(json.dumps(token, indent=2))
+    git(data, 'add', '.')
+    git(data, 'commit', '-q', '-m', 'Synthetic data')
+    git(data, 'push', '-q', 'origin', 'HEAD')
+    with open(root + "/rows.csv", 'w') as f:
+        f.write("x,y\n")
+        for i in range(100):
+            f.write(f'{start + i * 3600 + 1800},{rng.random() * 100:.6f}\n')
+    with open(app + "/pUD_status.json", 'w') as f:
+        f.write(json.dumps({'selected': 'TOK0.graph0.chain0', 'action_history': [], 'last_update': time.time()}, indent=2))
+
+
+def drop_caches(app):
+    for name in ('pUD_cache', 'pUD_index.json'):
+        if os.path.isdir(f'{app}/{name}'):
+            shutil.rmtree(f'{app}/{name}')
+        elif os.path.exists(f'{app}/{name}'):
+            os.remove(f'{app}/{name}')
+
+
+def cli_verbs(root):
+    # (name, argv, drop caches first); auto updates are disabled so only the verb is timed
+    return [
+        ('list', ['-u', 'd', '-l'], False),
+        ('list-info-cold', ['-u', 'd', '-li'], True),
+        ('list-info', ['-u', 'd', '-li'], False),
+        ('select', ['-u', 'd', '-s', 'TOK0.graph0.chain0'], False),
+        ('data-cold', ['-u', 'd', '-d'], True),
+        ('data', ['-u', 'd', '-d'], False),
+        ('data-tail', ['-u', 'd', '-d', '--tail', '20'], False),
+        ('plot', ['-u', 'd', '-p'], False),
+        ('add', ['-u', 'd', '-a', 'NOW', '1.5'], False),
+        ('remove', ['-u', 'd', '-r', '-1'], False),
+        ('add-from', ['-u', 'd', '--add-from', root + "/rows.csv"], False),
+        ('compact', ['-u', 'd', '--compact'], False),
+        ('commit', ['-u', 'd', '--commit'], False),
+        ('update', ['-u', 'f'], False),
+        ('push', ['-u', 'd', '--push'], False),
+    ]
+
+
+def load_module(app):
+    spec = importlib.util.spec_from_file_location('plsUpdateData_bench', app + "/plsUpdateData.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def function_verbs(m):
+    selected = ['TOK0', 'graph0', 'chain0']
+    return [
+        ('get_graphs', lambda g, s: m.get_graphs(s['datapath']).index),
+        ('list_graphs', lambda g, s: m.list_graphs(g, s['selected'], True)),
+        ('select_graph', lambda g, s: m.select_graph(g, selected, s)),
+        ('show_graph_data', lambda g, s: m.show_graph_data(g, s)),
+        ('plot_graph_data', lambda g, s: m.plot_graph_data(g, s)),
+        ('add_to_data', lambda g, s: m.add_to_data(g, ['NOW', '1.5'], None, s)),
+        ('remove_from_data', lambda g, s: m.remove_from_data(g, -1, s)),
+        ('git_state', lambda g, s: (m.invalidate_git_state(), m.git_state(s))),
+        ('fetch_updates', lambda g, s: m.fetch_updates(s, True)),
+        ('commit_changes', lambda g, s: (g.compact(), m.commit_changes(s))),
+    ]
+
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(mode, verb, times):
+    return {'mode': mode, 'verb': verb, 'runs': len(times), 'min': min(times),
+            'median': statistics.median(times), 'mean': statistics.mean(times), 'max': max(times)}
+
+
+def run_cli(app, root, runs, wanted):
+    results = []
+    env = dict(os.environ, PUD_NO_DAEMON='1')
+    for verb, argv, cold in cli_verbs(root):
+        if wanted and verb not in wanted:
+            continue
+        def run():
+            if cold:
+                drop_caches(app)
+            subprocess.run([sys.executable, app + "/plsUpdateData.py", *argv], env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results.append(result('cli', verb, timed(run, runs)))
+    return results
+
+
+def run_main(m, root, runs, wanted):
+    results = []
+    for verb, argv, cold in cli_verbs(root):
+        if wanted and verb not in wanted:
+            continue
+        def run():
+            if cold:
+                drop_caches(os.path.dirname(m.__file__))
+            m._status_on_disk.clear()
+            m.invalidate_git_state()
+            with redirect_stdout(io.StringIO()):
+                m.main(m.read_args(argv), m.read_status())
+        results.append(result('main', verb, timed(run, runs)))
+    return results
+
+
+def run_functions(m, runs, wanted):
+    results = []
+    m._status_on_disk.clear()
+    status = m.read_status()
+    graphs = m.get_graphs(status['datapath'])
+    for verb, fn in function_verbs(m):
+        if wanted and verb not in wanted:
+            continue
+        with redirect_stdout(io.StringIO()):
+            times = timed(lambda: fn(graphs, status), runs)
+        results.append(result('function', verb, times))
+    return results
+
+
+def stress_worker(app, worker, procs, adds, tokens, first, last):
+    # One writer: a third of its points go to a token of its own, a third to a
+    # series all writers share and a third, in x order, to a shared ordered
+    # series, half of those between its first two points and half after its end.
+    m = load_module(app)
+    times = []
+    failures = 0
+    for i in range(adds):
+        y = str(stress_value(worker, i))
+        if i % 3 == 0:
+            argv = ['-s', f'TOK{1 + worker % (tokens - 1)}.graph0.chain0', '-a', 'NOW', y]
+        elif i % 3 == 1:
+            argv = ['-s', 'TOK0.graph0.chain0', '-a', 'NOW', y]
+        elif i % 6 == 2:
+            argv = ['-s', 'TOK0.graph1.chain0', '-a', f'{first + (i * procs + worker) / (procs * adds):.6f}', y]
+        else:
+            # past the last point, so concurrent writers race for the end of the series
+            argv = ['-s', 'TOK0.graph1.chain0', '-a', f'{last + 1 + i * procs + worker:.6f}', y]
+        if worker == 0 and i % 10 == 9:
+            # folding journals rewrites the token files under the other writers
+            argv.append('--compact')
+        m._status_on_disk.clear()
+        m.invalidate_git_state()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()) as out:
+            code = m.main(m.read_args(['-u', 'd'] + argv), m.read_status())
+        times.append(time.perf_counter() - start)
+        if code != 0:
+            failures += 1
+            print(f'writer {worker}: {" ".join(argv)} failed\n{out.getvalue()}', file=sys.stderr)
+    return times, failures
+
+
+def stress_value(worker, i):
+    return 1000000 + worker * 10000 + i
+
+
+def run_stress(m, app, procs, adds, tokens):
+    if tokens < 2:
+        print('--stress needs at least 2 --tokens')
+        return [], False
+    with redirect_stdout(io.StringIO()):
+        m.main(m.read_args(['-u', 'd', '-s', 'TOK0.graph1.chain0', '--ordered', 'on']), m.read_status())
+    graphs = m.get_graphs(m.read_status()['datapath'])
+    xs = graphs.series_numbers('TOK0', 'graph1', 'chain0')[0]
+    first, last = xs[0], xs[-1]
+    expected = {}
+    for worker in range(procs):
+        for i in range(adds):
+            series = [f'TOK{1 + worker % (tokens - 1)}.graph0.chain0', 'TOK0.graph0.chain0', 'TOK0.graph1.chain0'][i % 3]
+            expected.setdefault(series, []).append(stress_value(worker, i))
+    before = {s: len(graphs.series_numbers(*s.split("."))[0]) for s in expected}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(procs) as pool:
+        done = list(pool.map(stress_worker, [app] * procs, range(procs), [procs] * procs, [adds] * procs,
+                             [tokens] * procs, [first] * procs, [last] * procs))
+    elapsed = time.perf_counter() - start
+    times = [t for worker_times, _ in done for t in worker_times]
+    failures = sum(f for _, f in done)
+    m._status_on_disk.clear()
+    status = m.read_status()
+    graphs = m.get_graphs(status['datapath'])
+    ok = failures == 0
+    for series, ys in expected.items():
+        t, g, c = series.split(".")
+        got = graphs.series_numbers(t, g, c)[1]
+        lost = sorted(set(ys) - set(got))
+        extra = len(got) - before[series] - len(ys)
+        sorted_ok = series != 'TOK0.graph1.chain0' or graphs.series_summary(t, g, c)['sorted']
+        ok = ok and not lost and extra == 0 and sorted_ok
+        print(f'{series: <22} {len(ys): >5} added  {len(lost): >3} lost  {extra: >+4} unexpected'
+              + ('' if sorted_ok else '  NOT SORTED'))
+    pending = [f for f in os.listdir(app) if f.startswith('pUD_pending.')]
+    ok = ok and not pending
+    print(f'{procs} processes x {adds} adds in {elapsed:.2f}s, {failures} failed runs, '
+          f'{len(pending)} crash reports left, {len(status["action_history"])} history entries')
+    print('stress: ' + ('ok' if ok else 'FAILED'))
+    return [result('stress', 'add', times)], ok
+
+
+def print_results(results, baseline=None):
+    old = {}
+    if baseline:
+        old = {(r['mode'], r['verb']): r for r in baseline['results']}
+    print(f'{"mode": <9} {"verb": <17} {"median ms": >10} {"min ms": >10} {"max ms": >10}' + ("   vs baseline" if old else ""))
+    for r in results:
+        line = f'{r["mode"]: <9} {r["verb"]: <17} {1000*r["median"]: >10.2f} {1000*r["min"]: >10.2f} {1000*r["max"]: >10.2f}'
+        before = old.get((r['mode'], r['verb']))
+        if before:
+            change = (r['median'] - before['median']) / before['median'] * 100
+            line += f'   {change:+7.1f}%'
+            if change > 10:
+                line += '  slower'
+        print(line)
+
+
+def package_revision():
+    out = subprocess.run(['git', '-C', PATH, 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, text=True)
+    return out.stdout.strip() if out.returncode == 0 else None
+
+
+def main(args):
+    modes = args.modes.split(",")
+    wanted = set(args.verbs.split(",")) if args.verbs else None
+    root = args.root or tempfile.mkdtemp(prefix='pUD_bench_')
+    if os.path.exists(root) and os.listdir(root):
+        print(f'{root} is not empty, please pick an empty or new --root')
+        return 1
+    config = {'tokens': args.tokens, 'graphs': args.graphs, 'chains': args.chains,
+              'points': args.points, 'seed': args.seed, 'runs': args.runs}
+    code = 0
+    try:
+        start = time.perf_counter()
+        os.makedirs(root, exist_ok=True)
+        app = setup_app(root)
+        m = load_module(app)
+        generate(root, app, args.tokens, args.graphs, args.chains, args.points, args.seed, m.TIME_FORMAT)
+        print(f'Generated {args.tokens} tokens x {args.graphs} graphs x {args.chains} chains x {args.points} points '
+              f'in {time.perf_counter() - start:.2f}s ({root})')
+        results = []
+        if args.stress:
+            results, ok = run_stress(m, app, args.stress, args.stress_adds, args.tokens)
+            modes = []
+            if not ok:
+                code = 1
+        if 'cli' in modes:
+            results += run_cli(app, root, args.runs, wanted)
+        if 'main' in modes:
+            results += run_main(m, root, args.runs, wanted)
+        if 'function' in modes:
+            results += run_functions(m, args.runs, wanted)
+    finally:
+        if not args.keep and not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(json.dumps({
+                'version': RESULTS_VERSION, 'timestamp': time.time(), 'revision': package_revision(),
+                'python': platform.python_version(), 'platform': platform.platform(),
+                'config': config, 'results': results}, indent=2))
+        print(f'Results written to {args.out}')
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main(read_args()))
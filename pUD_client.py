@@ -0,0 +1,63 @@
+import io
+import json
+import os
+import socket
+import sys
+
+# Thin entry point for plsUpdateData: forwards the command line to a running
+# `plsUpdateData.py --daemon` and runs plsUpdateData.py in-process otherwise.
+
+PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+def read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def reads_stdin(argv):
+    # Only --add-from - and --batch - read stdin, a bare - is also the open end of --x-range.
+    for i, arg in enumerate(argv):
+        name, _, value = arg.partition("=")
+        if name == arg:
+            value = argv[i+1] if i + 1 < len(argv) else None
+        # argparse takes unambiguous abbreviations, --add itself is -a
+        if value == '-' and name != '--add' and len(name) >= 5 and any(o.startswith(name) for o in ('--add-from', '--batch')):
+            return True
+    return False
+
+
+def forward(argv):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(PATH + "/pUD_daemon.sock"):
+        return None
+    if os.environ.get('PUD_NO_DAEMON') or '--daemon' in argv:
+        return None
+    request = {'argv': argv, 'cwd': os.getcwd()}
+    if reads_stdin(argv):
+        request['stdin'] = sys.stdin.read()
+        sys.stdin = io.StringIO(request['stdin'])
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(PATH + "/pUD_daemon.sock")
+            sock.sendall(json.dumps(request).encode())
+            sock.shutdown(socket.SHUT_WR)
+            response = json.loads(read_all(sock))
+    except (OSError, ValueError):
+        return None
+    if response.get('fallback'):
+        return None
+    sys.stdout.write(response['output'])
+    return response['code']
+
+
+if __name__ == '__main__':
+    code = forward(sys.argv[1:])
+    if code is None:
+        import runpy
+        sys.argv[0] = PATH + "/plsUpdateData.py"
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    sys.exit(code)
@@ -1,16 +1,43 @@
 import argparse
+import builtins
+import csv
+import ctypes
+import hashlib
+import io
 import json
 import math
+import mmap
 import os
+import select
+import shlex
+import shutil
+import socket
+import struct
 import subprocess
 import sys
 import time
-from datetime import datetime, timezone
+import traceback
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stderr, redirect_stdout
+from datetime import datetime, timedelta, timezone
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): writes are not locked against other runs
+    fcntl = None
 
 
 DATAPATH = ""
 DATAREPO = "git@github.com:sl0ddi/plsData.git"
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+CACHE_VERSION = 9
+JOURNAL_LIMIT = 64*1024
+INDEX_VERSION = 1
+WRITE_RETRIES = 20
+WATCH_POLL = 1.0
 
 def required_length_splitted(nmin, nmax, separator):
     class RequiredLength(argparse.Action):
@@ -24,7 +51,7 @@ def required_length_splitted(nmin, nmax, separator):
     return RequiredLength
 
 
-def read_args():
+def read_args(argv=None):
     parser = argparse.ArgumentParser(
         prog='plsUpdateData',
         description='Update plutus data graphs from commandline',
@@ -39,21 +66,76 @@ def read_args():
     parser.add_argument('-s', '--select', help="Selects a graph with identifier or index", nargs=1, type=str,
                         action=required_length_splitted(1, 3, "."), metavar=("TOKEN.GRAPH?.CHAIN?=global"))
     parser.add_argument('-a', '--add', help=f'Add datapoint to graph. Accepts number, timestamp ({TIME_FORMAT.replace("%","0")}) or "NOW".', nargs=2, metavar=("X", "Y"))
+    parser.add_argument('--add-from', help="Add datapoints from a CSV/NDJSON file or stdin (-). Rows are X,Y (to the selected graph) or TOKEN.GRAPH.CHAIN,X,Y.",
+                        metavar="FILE")
     parser.add_argument('-t', '--to', help="define index to add datapoint to.", nargs=1, type=int, metavar="INDEX")
     parser.add_argument('-r', '--remove', help="Remove datapoint from index", nargs=1, type=int, metavar="INDEX")
+    parser.add_argument('--ordered', help="Keep the selected graph ordered by x: new datapoints are placed by their x value "
+                                          "and duplicate x values are refused. 'on' sorts the graph once if needed. "
+                                          "The setting is kept in pUD_status.json on this machine only, other "
+                                          "machines keep adding to the end of the graph.",
+                        choices=['on', 'off'])
     parser.add_argument('-d', '--data', help="Show selected graph data.", action='store_true')
     parser.add_argument('-p', '--plot', help="plot selected graph data.", action='store_true')
+    parser.add_argument('--watch', help="Keep -d/-p open and redraw them when the selected graph changes.", action='store_true')
+    parser.add_argument('--combine', help="Resample graphs to --bucket intervals and show their sum, average or difference "
+                                          "with -d/-p instead of the selected graph.", choices=['sum', 'avg', 'diff'])
+    parser.add_argument('--over', help="Graphs for --combine and --export. TOKEN and TOKEN.GRAPH stand for all of their chains "
+                                       "(default: all chains of the selected graph for --combine, everything for --export).",
+                        nargs='+', metavar="TOKEN.GRAPH?.CHAIN?")
+    parser.add_argument('--bucket', help="Resampling interval for --combine.", default='day', choices=['hour', 'day'])
+    parser.add_argument('--size', help="Plot size as WIDTHxHEIGHT.", default=(66, 11), type=plot_size, metavar="WxH")
+    parser.add_argument('--x-range', help='Only use points with FROM <= x <= TO. Accepts number, timestamp, "NOW" or "-" for an open end.',
+                        nargs=2, metavar=("FROM", "TO"))
+    parser.add_argument('--rows', help="Only show datapoints FROM..TO (inclusive indexes, negative ones count from the end like -r).", nargs=2, type=int, metavar=("FROM", "TO"))
+    parser.add_argument('--head', help="Only show the first N datapoints of the selection.", type=row_count, metavar="N")
+    parser.add_argument('--tail', help="Only show the last N datapoints of the selection.", type=row_count, metavar="N")
+    parser.add_argument('--cache', help="Show parsed series cache stats or rebuild it.", nargs='?', const='stats',
+                        choices=['stats', 'rebuild'])
+    parser.add_argument('--layout', help="Convert every token to a storage layout: json (one TOKEN.json) or segments "
+                                         "(a TOKEN/ directory with monthly files per series, one point per line).",
+                        choices=LAYOUTS)
+    parser.add_argument('--workers', help="Number of processes used to read and convert token files on cold loads "
+                                          "(default: number of CPUs, 1 loads everything in this process).",
+                        type=int, metavar="N")
+    parser.add_argument('--export', help="Stream graphs as numeric series,x,y rows: csv, ndjson or bin "
+                                         "(little-endian float64 columns per graph). Unparsed points are left out, "
+                                         "--over and --x-range filter what is exported.", choices=['csv', 'ndjson', 'bin'])
+    parser.add_argument('--out', help="File for --export (default: stdout).", metavar="FILE")
+    parser.add_argument('--batch', help="Run operations from FILE or stdin (-), one per line, on one loaded state: "
+                                        "select ID, add X Y, add-from FILE, remove INDEX, ordered on|off, show, plot, commit, push "
+                                        "or plain options. Tokens are written once and commit/push run once at the end.",
+                        metavar="FILE")
+    parser.add_argument('--repo', help="Data repo to clone on first run (default: DATAREPO). Local paths work too.", metavar="URL")
+    parser.add_argument('--clone-depth', help="On first run, only clone the last N commits of the data repo.", type=int, metavar="N")
+    parser.add_argument('--blobless', help="On first run, make a partial clone that only downloads the token files "
+                                           "that get checked out.", action='store_true')
+    parser.add_argument('--sparse', help="On first run, only check out these tokens.", nargs='+', metavar="TOKEN")
+    parser.add_argument('--sparse-add', help="Check out more tokens in a sparse data repo.", nargs='+', metavar="TOKEN")
+    parser.add_argument('--compact', help="Fold pending journal entries back into the token files.", action='store_true')
     parser.add_argument('--commit', help=f'Commit changes.', action='store_true')
+    parser.add_argument('--daemon', help="Run a resident server that keeps graphs and status in memory, or stop it. "
+                                         "Calls made through pUD_client.py are forwarded to it while it runs.",
+                        nargs='?', const='run', choices=['run', 'stop'])
+    parser.add_argument('--profile', help="Print wall/CPU time, subprocesses and bytes read/written per phase, "
+                                          "and write them as a Chrome trace to TRACE_FILE if given.",
+                        nargs='?', const='', metavar="TRACE_FILE")
+    parser.add_argument('--background-update', help=argparse.SUPPRESS, action='store_true')
     parser.add_argument('--push', help=f'(Commit if necessary and) Push changes.', action='store_true')
 
-    return parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    if argv is None:
+        argv = sys.argv[1:]
+    return parser.parse_args(args=argv if argv else ['--help'])
 
 
-def read_status():
+_status_on_disk = {}
+
+def read_status(args=None):
     path = os.path.dirname(os.path.realpath(__file__))
     if os.path.exists(path+"/pUD_status.json"):
         with open(path+"/pUD_status.json") as f:
-            status = json.load(f)
+            _status_on_disk['content'] = f.read()
+        status = json.loads(_status_on_disk['content'])
     else:
         status = {
             "selected": "",
@@ -66,115 +148,1348 @@ def read_status():
         status['action_history'] = []
     if 'last_action' in status:
         del status['last_action']
+    if os.path.exists(path+"/pUD_update_result.json"):
+        with open(path+"/pUD_update_result.json") as f:
+            result = json.load(f)
+        os.remove(path+"/pUD_update_result.json")
+        if result['success']:
+            status['last_update'] = max(status['last_update'], result['last_update'])
+        if result['updated'] or not result['success']:
+            status['action_history'].insert(0, {'type': 'update', 'success': result['success'], 'arg': 'background',
+                                                'updated': result['updated'], 'timestamp': result['timestamp']})
+            del status['action_history'][10:]
+    for pending in sorted(os.listdir(path)):
+        # a run that died mid-action left its pUD_pending.PID.json behind
+        if pending.startswith("pUD_pending.") and pending.endswith(".json") and not pid_alive(pending.split(".")[1]):
+            try:
+                with open(f'{path}/{pending}') as f:
+                    status['crash_on'] = json.load(f)
+                os.remove(f'{path}/{pending}')
+            except (OSError, ValueError):
+                pass
 
     status['datapath'] = path + "/data/" + DATAPATH
     if not os.path.exists(path+ "/data"):
-        cwd = os.getcwd()
-        os.chdir(path)
-        out = subprocess.run(['git', 'clone', DATAREPO, "data"])
-        os.chdir(cwd)
-        if out.returncode != 0:
+        if not clone_data_repo(path + "/data", args):
             print('failed to clone datarepo..')
             return None
+    elif args and (args.repo or args.clone_depth or args.blobless or args.sparse):
+        print('The data repo is already cloned, --repo, --clone-depth, --blobless and --sparse only apply on first run')
     if not os.path.exists(path + "/data/" + DATAPATH):
         print('Could not find datapath!')
         return None
     save_status(status)
     return status
 
+def clone_data_repo(data, args=None):
+    repo = args.repo if args and args.repo else DATAREPO
+    clone = ['git', 'clone']
+    if args and (args.clone_depth or args.blobless):
+        if os.path.isdir(repo):
+            # git ignores --depth and --filter for plain local paths
+            repo = 'file://' + os.path.abspath(repo)
+        if args.clone_depth:
+            clone += ['--depth', str(args.clone_depth)]
+        if args.blobless:
+            clone.append('--filter=blob:none')
+    if not (args and args.sparse):
+        return subprocess.run(clone + [repo, data]).returncode == 0
+    # Nothing is checked out until the sparse set is in place, so a blobless
+    # clone only ever downloads the chosen tokens.
+    for command in (clone + ['--no-checkout', repo, data],
+                    ['git', '-C', data, 'sparse-checkout', 'set', '--no-cone', *sparse_patterns(args.sparse)],
+                    ['git', '-C', data, 'checkout']):
+        if subprocess.run(command).returncode != 0:
+            return False
+    return True
+
+
+def sparse_patterns(tokens):
+    # Non-cone patterns, cone mode would always check out every file next to the tokens.
+    prefix = "/" + os.path.join(DATAPATH, "")
+    return [pattern for t in tokens for pattern in (f'{prefix}{t}.json', f'{prefix}{t}/')]
+
+
+def sparse_add(status, tokens):
+    out = run_git(status, 'config', '--bool', 'core.sparseCheckout', capture=True)
+    if out.stdout.strip() != 'true':
+        print('The data repo is not a sparse checkout, every token is already checked out')
+        return False
+    out = run_git(status, 'ls-tree', '--name-only', 'HEAD', capture=True)
+    known = {name.split(".")[0] for name in out.stdout.splitlines()}
+    unknown = [t for t in tokens if t not in known]
+    if unknown:
+        print(f'Unknown tokens: {", ".join(unknown)}')
+        print(f'The data repo has: {", ".join(sorted(known))}')
+        return False
+    out = run_git(status, 'sparse-checkout', 'add', *sparse_patterns(tokens))
+    invalidate_git_state()
+    return out.returncode == 0
+
+
+def pid_alive(pid):
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
 def save_status(status):
+    # Status changes are buffered in memory and written once when main ends;
+    # set_pending_action keeps crash reports durable through pUD_pending.PID.json.
+    # Runs save one at a time, and one that finds another run's status on disk
+    # merges into it instead of writing over it.
+    content = json.dumps(status, indent=2)
+    if content == _status_on_disk.get('content'):
+        return
     path = os.path.dirname(os.path.realpath(__file__))
-    with open(path+"/pUD_status.json", 'w') as f:
-        f.write(json.dumps(status, indent=2))
+    with file_lock(path+"/pUD_status.lock"):
+        if os.path.exists(path+"/pUD_status.json"):
+            with open(path+"/pUD_status.json") as f:
+                on_disk = f.read()
+            if on_disk != _status_on_disk.get('content'):
+                base = json.loads(_status_on_disk['content']) if _status_on_disk.get('content') else {}
+                merged = merge_status(base, status, json.loads(on_disk))
+                status.clear()
+                status.update(merged)
+                content = json.dumps(status, indent=2)
+        write_atomic(path+"/pUD_status.json", content)
+        _status_on_disk['content'] = content
+
+
+def merge_status(base, ours, theirs):
+    # Three-way: what this run changed since it read base wins, everything else
+    # stays as the other run left it; both action histories are kept.
+    merged = dict(theirs)
+    for key, value in ours.items():
+        if base.get(key) != value:
+            merged[key] = value
+    for key in base.keys():
+        if key not in ours and merged.get(key) == base[key]:
+            del merged[key]
+    merged['last_update'] = max(ours.get('last_update', 0), theirs.get('last_update', 0))
+    history = ours.get('action_history', [])
+    history = history + [e for e in theirs.get('action_history', []) if e not in history]
+    merged['action_history'] = sorted(history, key=lambda e: e.get('timestamp', 0), reverse=True)[:10]
+    return merged
+
+
+def write_atomic(file, content):
+    # the temporary name is per process, so concurrent writers never share one
+    with open(f'{file}.{os.getpid()}.tmp', 'w') as f:
+        f.write(content)
+    os.replace(f'{file}.{os.getpid()}.tmp', file)
+
+
+@contextmanager
+def file_lock(file):
+    # Exclusive flock on FILE for the with block. Opened read-only, so taking
+    # the lock does not look like a write to --watch.
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(file, os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+class GraphStore(Mapping):
+    # Token files are only listed here, each one is parsed on first access.
+    # Single point changes are appended to a per-token journal that is
+    # replayed on load and folded back into TOKEN.json by compact().
+    # Reading and writing a token happen under its lock in the journal
+    # directory; writes only go through on the revision (stamp) the token was
+    # loaded at, see log() and save().
+    def __init__(self, dp, cache=None, journal_path=None, index_file=None, workers=None):
+        self.dp = dp
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.journal_path = journal_path
+        self.index_file = index_file
+        self._index = None
+        self.files = list_token_files(dp)
+        self.loaded = {}
+        self.stamps = {}
+        self.numbers = {}
+        self.summaries = {}
+        self.deferred = None
+        self.locked = set()
+
+    def __getitem__(self, token):
+        if token not in self.loaded:
+            journal = self.journal_file(token)
+            with self.lock(token):
+                raw, data = load_token(self.files[token])
+                if journal and os.path.exists(journal):
+                    replay_journal(token, data, raw, journal)
+                self.stamps[token] = self.stamp(token)
+            for g in data.keys():
+                for c in data[g].keys():
+                    data[g][c] = Series(data[g][c])
+            self.loaded[token] = data
+        return self.loaded[token]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def stamp(self, token):
+        return (*token_stat(self.files[token]), journal_fingerprint(self.journal_file(token)))
+
+    @contextmanager
+    def lock(self, token):
+        # held only while a token is read or written; nested uses share it
+        if not self.journal_path or token in self.locked:
+            yield
+            return
+        os.makedirs(self.journal_path, exist_ok=True)
+        with file_lock(self.lock_file(token)):
+            self.locked.add(token)
+            try:
+                yield
+            finally:
+                self.locked.discard(token)
+
+    def lock_file(self, token):
+        if self.journal_path:
+            return f'{self.journal_path}/{token}.lock'
+        return None
+
+    def current(self, token):
+        # the token on disk is still the revision it was loaded at
+        return token in self.loaded and self.stamp(token) == self.stamps.get(token)
+
+    def refresh(self):
+        # Pick up token files changed by someone else since they were loaded.
+        files = list_token_files(self.dp)
+        for token in list(self.loaded.keys()):
+            if files.get(token) != self.files.get(token) or self.stamp(token) != self.stamps[token]:
+                self.forget(token)
+        self.files = files
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = SelectionIndex(self.index_file, self)
+        return self._index
+
+    def warm(self, tokens):
+        # Cold tokens are read, decoded and converted by a pool of worker processes.
+        # Only their graph/chain layout and cache entries come back, in token order.
+        cold = [t for t in tokens if t not in self.loaded and (self.cache is None or not self.cache_is_valid(t))]
+        layouts = {}
+        if self.workers < 2 or len(cold) < 2:
+            return layouts
+        if self.journal_path:
+            os.makedirs(self.journal_path, exist_ok=True)
+        cache_path = self.cache.path if self.cache is not None else None
+        with ProcessPoolExecutor(min(self.workers, len(cold))) as pool:
+            scans = pool.map(scan_token, cold, [self.files[t] for t in cold], [self.journal_file(t) for t in cold],
+                             [self.lock_file(t) for t in cold], [cache_path] * len(cold))
+            for t, layout, entry in scans:
+                layouts[t] = layout
+                if entry is not None:
+                    self.cache.misses += 1
+                    self.cache.put(t, entry)
+        if cache_path:
+            self.cache.save_index()
+        return layouts
+
+    def forget(self, token):
+        self.loaded.pop(token, None)
+        self.stamps.pop(token, None)
+        self.numbers.pop(token, None)
+        self.summaries.pop(token, None)
+
+    def journal_file(self, token):
+        if self.journal_path:
+            return f'{self.journal_path}/{token}.jsonl'
+        return None
+
+    def save(self, token, folded=False):
+        # folded: only journal entries were written back, so the cached series still hold.
+        # Returns False, and drops the token, if someone else wrote it since it was loaded;
+        # folding just rereads it.
+        wait_for_background_update()
+        with self.lock(token):
+            if not self.current(token):
+                self.forget(token)
+                if not folded:
+                    return False
+            if self.deferred:
+                # held back ops are part of what gets written now
+                self.deferred.pop(token, None)
+            cached = folded and self.cache is not None and self.cache_is_valid(token)
+            write_token(self.files[token], self[token])
+            invalidate_git_state()
+            journal = self.journal_file(token)
+            if journal and os.path.exists(journal):
+                os.remove(journal)
+            if cached:
+                self.cache.restamp(token, self.files[token], journal)
+            self.stamps[token] = self.stamp(token)
+        self.numbers.pop(token, None)
+        self.summaries.pop(token, None)
+        if self._index is not None:
+            self._index.restamp(token)
+        return True
+
+    def defer(self):
+        # Batch mode: ops are held back and journaled once per token by flush().
+        self.deferred = {}
+
+    def flush(self):
+        # tokens whose held back ops could not be written
+        deferred, self.deferred = self.deferred or {}, None
+        return [token for token, ops in deferred.items() if not self.log(token, ops)]
+
+    def cached(self, token):
+        # Tokens with held back ops differ from their files, so the cache can't describe them.
+        return self.cache is not None and not (self.deferred and token in self.deferred)
+
+    def log(self, token, ops):
+        # Ops made on an older revision of the token are refused (False) unless
+        # they are all adds, which land at the end of any revision. Either way
+        # the token is dropped then, callers redo refused changes on a fresh load.
+        # Ordered series are always written as inserts, even at the end, since
+        # where their points go depends on the revision.
+        if self.deferred is not None:
+            self.deferred.setdefault(token, []).extend(ops)
+            self.numbers.pop(token, None)
+            self.summaries.pop(token, None)
+            return True
+        journal = self.journal_file(token)
+        if not journal:
+            return self.save(token)
+        with self.lock(token):
+            current = self.current(token)
+            if not current and any(op['op'] != 'add' for op in ops):
+                self.forget(token)
+                return False
+            # adds fit any revision, so a cache entry for what is on disk takes them too
+            cached = False
+            if self.cache is not None:
+                if not self.cache_is_valid(token):
+                    self.cache.reload_index()
+                cached = self.cache_is_valid(token)
+            trim_journal(journal)
+            with open(journal, 'a') as f:
+                if f.tell() == 0:
+                    f.write(json.dumps({'base': git_blob_hash(read_token(self.files[token]))}) + "\n")
+                f.write("".join(json.dumps(op) + "\n" for op in ops))
+                size = f.tell()
+            if current:
+                self.stamps[token] = self.stamp(token)
+            else:
+                self.forget(token)
+            self.numbers.pop(token, None)
+            self.summaries.pop(token, None)
+            if cached and not self.cache.append(token, ops, journal):
+                self.cache.update(token, *self.patch_series(token, ops), journal)
+            if size > JOURNAL_LIMIT:
+                self.save(token, folded=True)
+        return True
+
+    def patch_series(self, token, ops):
+        # The cached series and summaries still describe the token before ops,
+        # so they are brought along op by op instead of reparsing the token.
+        numbers, summaries = self.cache.read(token)
+        numbers = dict(numbers)
+        summaries = dict(summaries)
+        formats = dict(self.cache.formats(token))
+        touched = {}
+        for op in ops:
+            key = f"{op['g']}.{op['c']}"
+            if key not in touched:
+                touched[key] = self.cache.points(token, key).copy()
+                numbers[key] = (touched[key].xs, touched[key].ys)
+                summaries[key] = dict(summaries[key])
+            points = touched[key]
+            apply_series_op(points.xs, points.ys, summaries[key], op, points)
+            summaries[key]['last_raw'] = points[-1] if len(points) else None
+        for key, points in touched.items():
+            formats[key] = series_formats(points)
+        return numbers, summaries, formats
+
+    def append(self, token, g, c, point):
+        # An add lands at the end of whatever revision is on disk, so the token is
+        # only loaded for it when it already is, or is about to be written whole.
+        if token in self.loaded or self.deferred is not None or not self.journal_path:
+            self[token][g][c].append(point)
+        return self.log(token, [{'op': 'add', 'g': g, 'c': c, 'p': point}])
+
+    def compact(self):
+        compacted = []
+        for token in self.keys():
+            journal = self.journal_file(token)
+            if journal and os.path.exists(journal):
+                self.save(token, folded=True)
+                compacted.append(token)
+        return compacted
+
+    def convert(self, token, layout):
+        # Writes the token, pending journal entries included, in the other layout
+        # and removes the old file or directory.
+        path = token_path(self.dp, token, layout)
+        old = self.files[token]
+        if path == old:
+            return False
+        wait_for_background_update()
+        with self.lock(token):
+            if not self.current(token):
+                self.forget(token)
+            write_token(path, self[token])
+            if os.path.isdir(old):
+                shutil.rmtree(old)
+            else:
+                os.remove(old)
+            invalidate_git_state()
+            self.files[token] = path
+            journal = self.journal_file(token)
+            if journal and os.path.exists(journal):
+                os.remove(journal)
+            self.stamps[token] = self.stamp(token)
+        if self._index is not None:
+            self._index.restamp(token)
+        return True
+
+    def cache_is_valid(self, token):
+        return self.cache.is_valid(token, self.files[token], self.journal_file(token))
+
+    def token_columns(self, t):
+        # Numbers and summaries of one token without keeping them, or its points, around.
+        loaded = t in self.loaded
+        if not self.cached(t):
+            summaries = {}
+            numbers = token_numbers(self[t], summaries)
+        else:
+            numbers, summaries = self.read_cache(t)
+        if not loaded:
+            self.forget(t)
+        return numbers, summaries
 
-def get_graphs(dp):
-    files = os.listdir(dp)
-    graphs = {}
-    for file in files:
+    def update_cache(self, t):
+        with self.lock(t):
+            if not self.cache_is_valid(t):
+                if t in self.loaded and not self.current(t):
+                    # the entry is stamped with what is on disk, so it has to be built from that
+                    self.forget(t)
+                self.cache.write(t, self.files[t], self[t], self.journal_file(t))
+
+    def read_cache(self, t):
+        # under the token's lock, as every write of its columns is
+        with self.lock(t):
+            self.update_cache(t)
+            return self.cache.read(t)
+
+    def series_numbers(self, t, g, c):
+        if t not in self.numbers:
+            if not self.cached(t):
+                self.summaries[t] = {}
+                self.numbers[t] = token_numbers(self[t], self.summaries[t])
+            else:
+                self.numbers[t], self.summaries[t] = self.read_cache(t)
+        return self.numbers[t][f'{g}.{c}']
+
+    def series_points(self, t, g, c):
+        # One series with its stored values, served by the cache without loading the token when it can.
+        if t in self.loaded or not self.cached(t):
+            return self[t][g][c]
+        with self.lock(t):
+            self.update_cache(t)
+            return self.cache.points(t, f'{g}.{c}')
+
+    def series_summary(self, t, g, c):
+        # Served from the cache index alone, without mapping or parsing any points.
+        if t not in self.summaries:
+            if not self.cached(t):
+                self.series_numbers(t, g, c)
+            else:
+                self.update_cache(t)
+                self.summaries[t] = self.cache.index['tokens'][t]['summaries']
+        return self.summaries[t][f'{g}.{c}']
+
+    def series_errors(self, t, g, c):
+        return self.series_summary(t, g, c)['errors']
+
+
+class SelectionIndex:
+    # Flat token.graph.chain numbering plus lower-cased identifier lookups,
+    # persisted with per-token file stamps so only changed tokens are re-read.
+    def __init__(self, file, graphs):
+        self.file = file
+        self.graphs = graphs
+        saved = {}
+        if file and os.path.exists(file):
+            with open(file) as f:
+                saved = json.load(f)
+            if saved.get('version') != INDEX_VERSION:
+                saved = {}
+        tokens = saved.get('tokens', {})
+        changed = list(tokens.keys()) != list(graphs.files.keys())
+        stamps = {t: file_stamp(token_file) for t, token_file in graphs.files.items()}
+        stale = [t for t in graphs.files.keys() if t not in tokens or tokens[t]['stamp'] != stamps[t]]
+        layouts = graphs.warm(stale)
+        for t in stale:
+            if t not in layouts:
+                layouts[t] = {g: list(graphs[t][g].keys()) for g in graphs[t].keys()}
+            tokens[t] = {'stamp': stamps[t], 'graphs': layouts[t]}
+            changed = True
+        self.tokens = {t: tokens[t] for t in graphs.files.keys()}
+        if changed or 'entries' not in saved:
+            self.build()
+            self.save()
+        else:
+            self.entries = saved['entries']
+            self.tree = saved['tree']
+            self.names = saved['names']
+            self.defaults = saved['defaults']
+
+    def build(self):
+        self.entries = []
+        self.tree = {}
+        self.names = {}
+        self.defaults = {}
+        for t, token in self.tokens.items():
+            self.tree[t] = {}
+            self.names[t.lower()] = t
+            graphs = token['graphs']
+            self.defaults[t] = f'{t}.{list(graphs.keys())[0]}' if len(graphs) == 1 else None
+            for g, chains in graphs.items():
+                self.tree[t][g] = {}
+                self.names[f'{t}.{g}'.lower()] = f'{t}.{g}'
+                if len(graphs) == 1 and len(chains) > 0:
+                    self.defaults[f'{t}.{g}'] = f'{t}.{g}.{chains[0]}'
+                elif 'global' in chains:
+                    self.defaults[f'{t}.{g}'] = f'{t}.{g}.global'
+                else:
+                    self.defaults[f'{t}.{g}'] = None
+                for c in chains:
+                    self.tree[t][g][c] = len(self.entries)
+                    self.names[f'{t}.{g}.{c}'.lower()] = f'{t}.{g}.{c}'
+                    self.entries.append(f'{t}.{g}.{c}')
+
+    def save(self):
+        if self.file:
+            write_atomic(self.file, json.dumps({
+                'version': INDEX_VERSION, 'tokens': self.tokens, 'entries': self.entries,
+                'tree': self.tree, 'names': self.names, 'defaults': self.defaults}))
+
+    def restamp(self, token):
+        # our own writes only touch points, the graph/chain layout stays the same
+        if token in self.tokens:
+            self.tokens[token]['stamp'] = file_stamp(self.graphs.files[token])
+            self.save()
+
+    def lookup(self, *parts):
+        return self.names.get(".".join(parts).lower())
+
+
+def file_stamp(file):
+    return list(token_stat(file))
+
+
+def file_identity(st):
+    # st: os.stat() result or an open file descriptor
+    if isinstance(st, int):
+        st = os.fstat(st)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def list_token_files(dp):
+    files = {}
+    for file in os.listdir(dp):
         if file.endswith(".json"):
-            token = file.split(".")[0]
-            with open(dp +"/"+file) as f:
-                data = json.load(f)
-            graphs[token] = data
-    return graphs
+            files[file.split(".")[0]] = dp + "/" + file
+        elif os.path.exists(f'{dp}/{file}/{SEGMENTS_FILE}'):
+            files[file] = dp + "/" + file
+    return files
+
+
+# Segmented layout: TOKEN/series.json lists the graphs and chains in order and
+# every series is split into TOKEN/GRAPH/CHAIN/NNNN-YYYY-MM.jsonl files, one
+# point per line. A segment holds consecutive points of the same (UTC) month,
+# so appending only rewrites the newest segment or starts a new one.
+SEGMENTS_FILE = "series.json"
+LAYOUTS = ['json', 'segments']
+
+def token_path(dp, token, layout):
+    return f'{dp}/{token}.json' if layout == 'json' else f'{dp}/{token}'
+
+
+def token_layout(path):
+    return 'json' if path.endswith(".json") else 'segments'
+
+
+def token_stat(path):
+    # size and mtime of TOKEN.json, or summed/latest over a segmented token
+    if token_layout(path) == 'json':
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    size = 0
+    mtime = 0
+    for root, _, files in os.walk(path):
+        mtime = max(mtime, os.stat(root).st_mtime_ns)
+        for name in files:
+            st = os.stat(f'{root}/{name}')
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+    return size, mtime
+
+
+def segment_names(path, g, c):
+    if not os.path.isdir(f'{path}/{g}/{c}'):
+        return []
+    names = [name for name in os.listdir(f'{path}/{g}/{c}') if name.endswith(".jsonl")]
+    return sorted(names, key=lambda name: int(name.split("-")[0]))
+
+
+def read_token(path):
+    # The bytes journals and the cache hash: TOKEN.json, or for a segmented token
+    # series.json and every segment (prefixed with its path) joined by NULs.
+    if token_layout(path) == 'json':
+        with open(path, 'rb') as f:
+            return f.read()
+    with open(f'{path}/{SEGMENTS_FILE}', 'rb') as f:
+        parts = [f.read()]
+    for g, chains in json.loads(parts[0])['graphs'].items():
+        for c in chains:
+            for name in segment_names(path, g, c):
+                with open(f'{path}/{g}/{c}/{name}', 'rb') as f:
+                    parts.append(f'{g}/{c}/{name}\n'.encode() + f.read())
+    return b'\0'.join(parts)
+
+
+def load_token(path):
+    raw = read_token(path)
+    if token_layout(path) == 'json':
+        return raw, json.loads(raw)
+    parts = raw.split(b'\0')
+    data = {g: {c: [] for c in chains} for g, chains in json.loads(parts[0])['graphs'].items()}
+    for part in parts[1:]:
+        name, _, lines = part.partition(b'\n')
+        g, c, _ = name.decode().rsplit("/", 2)
+        data[g][c].extend(json.loads(b'[' + b','.join(lines.splitlines()) + b']'))
+    return raw, data
+
+
+def segment_month(x):
+    try:
+        return time.strftime('%Y-%m', time.gmtime(x))
+    except (OverflowError, OSError, ValueError):
+        return 'none'
+
+
+def series_segments(series):
+    points = Series.to_json(series)
+    segments = []
+    month = None
+    for i, x in enumerate(series.xs):
+        if segment_month(x) != month:
+            month = segment_month(x)
+            segments.append([f'{len(segments):04d}-{month}.jsonl', i])
+    for n, (name, start) in enumerate(segments):
+        end = segments[n+1][1] if n + 1 < len(segments) else len(points)
+        segments[n][1] = "".join(json.dumps(p, separators=(',', ':')) + "\n" for p in points[start:end])
+    return segments
+
+
+def write_token(path, data):
+    if token_layout(path) == 'json':
+        write_atomic(path, json.dumps(data, indent=2, default=Series.to_json))
+        return
+    # Only segments whose content changed are written, stale ones are removed.
+    wanted = {SEGMENTS_FILE: json.dumps({'graphs': {g: list(data[g].keys()) for g in data.keys()}}, indent=2)}
+    for g in data.keys():
+        for c in data[g].keys():
+            for name, content in series_segments(data[g][c]):
+                wanted[f'{g}/{c}/{name}'] = content
+    existing = set()
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            existing.update(os.path.relpath(f'{root}/{name}', path) for name in files)
+    for name, content in wanted.items():
+        file = f'{path}/{name}'
+        if name in existing and os.path.getsize(file) == len(content.encode()):
+            with open(file) as f:
+                if f.read() == content:
+                    continue
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        write_atomic(file, content)
+    for name in existing - wanted.keys():
+        os.remove(f'{path}/{name}')
+    for root, dirs, files in os.walk(path, topdown=False):
+        if root != path and not os.listdir(root):
+            os.rmdir(root)
+
+
+def scan_token(token, file, journal, lock_file, cache_path):
+    # Worker side of GraphStore.warm(); the points themselves stay in the worker.
+    entry = None
+    with (file_lock(lock_file) if lock_file else nullcontext()):
+        raw, data = load_token(file)
+        if journal and os.path.exists(journal):
+            replay_journal(token, data, raw, journal)
+        if cache_path:
+            entry = SeriesCache(cache_path).build(token, file, data, journal)
+    return token, {g: list(data[g].keys()) for g in data.keys()}, entry
+
+
+def replay_journal(token, data, raw, journal):
+    with open(journal) as f:
+        lines = f.readlines()
+    try:
+        base = json.loads(lines[0]).get('base') if lines else None
+    except ValueError:
+        base = None
+    if lines and base != git_blob_hash(raw):
+        os.replace(journal, journal + ".stale")
+        print(f'Journal of {token} was written for another version of {token}.json, moved it to {journal}.stale')
+        return
+    for line in lines[1:]:
+        if not line.endswith("\n"):
+            break
+        try:
+            op = json.loads(line)
+        except ValueError:
+            # a torn line an older run appended to, the rest of the journal still applies
+            print(f'Skipped a damaged line in the journal of {token}')
+            continue
+        points = data[op['g']][op['c']]
+        if op['op'] == 'add':
+            points.append(op['p'])
+        elif op['op'] == 'insert':
+            points.insert(op['i'], op['p'])
+        elif op['op'] == 'remove':
+            del points[op['i']]
+
+
+def trim_journal(journal):
+    # A run killed mid-write leaves a line without its '\n'. Appending after it
+    # would fuse it with the next op, so it is cut off first.
+    try:
+        with open(journal, 'rb+') as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                chunk = f.read(end - start)
+                if b'\n' in chunk:
+                    end = start + chunk.rindex(b'\n') + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+    except FileNotFoundError:
+        pass
+
+
+def journal_fingerprint(journal):
+    if journal and os.path.exists(journal):
+        st = os.stat(journal)
+        return [st.st_size, st.st_mtime_ns]
+    return None
+
+
+KIND_RAW, KIND_FLOAT, KIND_INT, KIND_STR, KIND_INT_STR, KIND_TIME = range(6)
+
+class Series:
+    # One chain's points as float64 columns. kinds records per axis how values
+    # were written (one code for the whole axis, or a bytearray with a code per
+    # value when formats are mixed) so to_json() can write them back the same
+    # way. Values no format reproduces are kept as they were in raw, keyed by
+    # (index, axis).
+    __slots__ = ('xs', 'ys', 'kinds', 'raw')
+
+    def __init__(self, points=()):
+        self.xs = parse_values([p[0] for p in points])
+        self.ys = parse_values([p[1] for p in points])
+        self.kinds = [None, None]
+        self.raw = {}
+        for axis, numbers in ((0, self.xs), (1, self.ys)):
+            values = [p[axis] for p in points]
+            kinds = bytearray(value_kind(v, n) for v, n in zip(values, numbers))
+            if kinds and kinds.count(kinds[0]) == len(kinds):
+                self.kinds[axis] = kinds[0]
+            elif kinds:
+                self.kinds[axis] = kinds
+            if KIND_RAW in kinds:
+                for i, kind in enumerate(kinds):
+                    if kind == KIND_RAW:
+                        self.raw[(i, axis)] = values[i]
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.xs)
+        if not 0 <= i < len(self.xs):
+            raise IndexError('series index out of range')
+        return [self.value(i, 0), self.value(i, 1)]
+
+    def __delitem__(self, i):
+        if i < 0:
+            i += len(self.xs)
+        del self.xs[i]
+        del self.ys[i]
+        for kinds in self.kinds:
+            if isinstance(kinds, bytearray):
+                del kinds[i]
+        if self.raw:
+            self.raw = {(j - (j > i), axis): v for (j, axis), v in self.raw.items() if j != i}
+
+    def value(self, i, axis):
+        if (i, axis) in self.raw:
+            return self.raw[(i, axis)]
+        kinds = self.kinds[axis]
+        return format_value((self.xs, self.ys)[axis][i], kinds if isinstance(kinds, int) else kinds[i])
+
+    def insert(self, i, point):
+        if self.raw:
+            self.raw = {(j + (j >= i), axis): v for (j, axis), v in self.raw.items()}
+        for axis, numbers in ((0, self.xs), (1, self.ys)):
+            n = parse_value(point[axis])
+            numbers.insert(i, math.nan if n is None else n)
+            kind = value_kind(point[axis], numbers[i])
+            kinds = self.kinds[axis]
+            if kinds is None or (len(numbers) == 1 and not isinstance(kinds, bytearray)):
+                self.kinds[axis] = kind
+            elif isinstance(kinds, bytearray):
+                kinds.insert(i, kind)
+            elif kinds != kind:
+                self.kinds[axis] = bytearray([kinds]) * (len(numbers) - 1)
+                self.kinds[axis].insert(i, kind)
+            if kind == KIND_RAW:
+                self.raw[(i, axis)] = point[axis]
+
+    def append(self, point):
+        self.insert(len(self.xs), point)
+
+    def copy(self):
+        # also turns one served from the cache's mapped file into one that can change
+        kinds = [k if k is None or isinstance(k, int) else bytearray(k) for k in self.kinds]
+        series = Series.from_columns(array('d', memoryview(self.xs).tobytes()),
+                                     array('d', memoryview(self.ys).tobytes()), kinds)
+        series.raw = dict(self.raw)
+        return series
+
+    @classmethod
+    def from_columns(cls, xs, ys, kinds=(KIND_FLOAT, KIND_FLOAT)):
+        series = cls()
+        series.xs = xs
+        series.ys = ys
+        series.kinds = list(kinds)
+        return series
+
+    def reorder(self, order):
+        self.xs = array('d', [self.xs[i] for i in order])
+        self.ys = array('d', [self.ys[i] for i in order])
+        for axis, kinds in enumerate(self.kinds):
+            if isinstance(kinds, bytearray):
+                self.kinds[axis] = bytearray(kinds[i] for i in order)
+        if self.raw:
+            moved = {old: new for new, old in enumerate(order)}
+            self.raw = {(moved[j], axis): v for (j, axis), v in self.raw.items()}
+
+    def errors(self):
+        errors = [{'index': i, 'axis': 'xy'[axis], 'value': v}
+                  for (i, axis), v in self.raw.items() if parse_value(v) is None]
+        return sorted(errors, key=lambda e: (e['index'], e['axis']))
+
+    def to_json(self):
+        columns = []
+        for numbers, kinds in zip((self.xs, self.ys), self.kinds):
+            if isinstance(kinds, bytearray):
+                columns.append([format_value(n, kind) for n, kind in zip(numbers, kinds)])
+            elif kinds == KIND_FLOAT:
+                columns.append(numbers.tolist())
+            else:
+                columns.append([format_value(n, kinds) for n in numbers])
+        for (i, axis), v in self.raw.items():
+            columns[axis][i] = v
+        return [list(p) for p in zip(*columns)]
+
+
+def value_kind(v, n):
+    # How v was written, if format_value(n, kind) gives v back; KIND_RAW otherwise.
+    if type(v) is float:
+        return KIND_FLOAT
+    if type(v) is int:
+        return KIND_INT if n.is_integer() and int(n) == v else KIND_RAW
+    if type(v) is str and not math.isnan(n):
+        if len(v) == 19 and v[4] == '-':
+            return KIND_TIME if format_timestamp(n) == v else KIND_RAW
+        if repr(n) == v:
+            return KIND_STR
+        if n.is_integer() and str(int(n)) == v:
+            return KIND_INT_STR
+    return KIND_RAW
+
+
+def format_value(n, kind):
+    if math.isnan(n):
+        return n
+    if kind == KIND_INT:
+        return int(n)
+    if kind == KIND_STR:
+        return repr(n)
+    if kind == KIND_INT_STR:
+        return str(int(n))
+    if kind == KIND_TIME:
+        return format_timestamp(n)
+    return n
+
+
+def format_timestamp(n):
+    try:
+        return time.strftime(TIME_FORMAT, time.localtime(n))
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+class SeriesCache:
+    # Numeric columns of every series, one float64 file per token. Entries are
+    # checked against the token file's size/mtime and, when only the mtime
+    # moved (checkouts), its git blob hash. They also record which .f64 file
+    # (inode, size, mtime) they were written with, so columns another run
+    # replaced are never read through an entry that does not describe them.
+    # Each column is followed by some room, so points added at the end of a
+    # series are written in place instead of rewriting the file. After all
+    # columns come their kinds, a byte per slot, so stored values can be shown
+    # from the cache; values no kind reproduces are kept in the entry.
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.index_stamp = None
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+
+    def load_index(self):
+        if self.index is None:
+            self.index = self.read_index()
+        return self.index
+
+    def read_index(self):
+        index = self.new_index()
+        self.index_stamp = None
+        if os.path.exists(self.path + "/index.json"):
+            with open(self.path + "/index.json") as f:
+                saved = json.load(f)
+                self.index_stamp = file_identity(f.fileno())
+            if all(saved.get(k) == v for k, v in index.items() if k != 'tokens'):
+                index = saved
+        return index
+
+    def new_index(self):
+        # timestamps are kept as KIND_TIME only if they read back the same in this time zone
+        return {'version': CACHE_VERSION, 'byteorder': sys.byteorder,
+                'zone': [time.timezone, time.altzone, *time.tzname], 'tokens': {}}
+
+    def put(self, token, entry):
+        self.load_index()['tokens'][token] = entry
+        self.dirty.add(token)
+
+    def save_index(self):
+        # Other runs save their entries too: if the index changed on disk since
+        # it was read, only the entries this run touched are put over it.
+        os.makedirs(self.path, exist_ok=True)
+        with file_lock(self.path + "/index.lock"):
+            stamp = None
+            if os.path.exists(self.path + "/index.json"):
+                stamp = file_identity(os.stat(self.path + "/index.json"))
+            if stamp != self.index_stamp:
+                tokens = self.index['tokens']
+                self.index = self.read_index()
+                self.index['tokens'].update({t: tokens[t] for t in self.dirty if t in tokens})
+            with open(f'{self.path}/index.json.{os.getpid()}.tmp', 'w') as f:
+                f.write(json.dumps(self.index))
+                f.flush()
+                self.index_stamp = file_identity(f.fileno())
+            os.replace(f'{self.path}/index.json.{os.getpid()}.tmp', self.path + "/index.json")
+        self.dirty.clear()
+
+    def is_valid(self, token, file, journal=None):
+        entry = self.load_index()['tokens'].get(token)
+        if not entry or not os.path.exists(f'{self.path}/{token}.f64'):
+            return False
+        if entry.get('columns') != file_identity(os.stat(f'{self.path}/{token}.f64')):
+            return False
+        size, mtime_ns = token_stat(file)
+        if size != entry['size'] or journal_fingerprint(journal) != entry['journal']:
+            return False
+        if mtime_ns != entry['mtime_ns']:
+            if git_blob_hash(read_token(file)) != entry['blob']:
+                return False
+            entry['mtime_ns'] = mtime_ns
+            self.dirty.add(token)
+            self.save_index()
+        return True
+
+    def read(self, token):
+        self.hits += 1
+        entry = self.index['tokens'][token]
+        columns, _ = self.map(token)
+        numbers = {}
+        for key, (offset, count, room) in entry['series'].items():
+            numbers[key] = (columns[offset:offset+count], columns[offset+room:offset+room+count])
+        return numbers, entry['summaries']
+
+    def map(self, token):
+        slots = self.index['tokens'][token]['slots']
+        mapped = memoryview(b'')
+        with open(f'{self.path}/{token}.f64', 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return mapped[:8*slots].cast('d'), mapped[8*slots:9*slots]
+
+    def formats(self, token):
+        entry = self.index['tokens'][token]
+        _, kinds = self.map(token)
+        formats = {}
+        for key, (offset, count, room) in entry['series'].items():
+            formats[key] = (kinds[offset:offset+count], kinds[offset+room:offset+room+count], entry['raw'].get(key, []))
+        return formats
+
+    def points(self, token, key):
+        # One series as a read-only Series over the mapped file, for showing its stored values.
+        entry = self.index['tokens'][token]
+        columns, kinds = self.map(token)
+        offset, count, room = entry['series'][key]
+        points = Series.from_columns(columns[offset:offset+count], columns[offset+room:offset+room+count],
+                                     (kinds[offset:offset+count], kinds[offset+room:offset+room+count]))
+        points.raw = {(i, axis): v for i, axis, v in entry['raw'].get(key, [])}
+        return points
+
+    def write(self, token, file, data, journal=None):
+        self.misses += 1
+        self.put(token, self.build(token, file, data, journal))
+        self.save_index()
+
+    def build(self, token, file, data, journal=None):
+        size, mtime_ns = token_stat(file)
+        summaries = {}
+        formats = {}
+        numbers = token_numbers(data, summaries, formats)
+        return self.write_columns(token, numbers, summaries, formats, {
+            'size': size, 'mtime_ns': mtime_ns, 'blob': git_blob_hash(read_token(file)),
+            'journal': journal_fingerprint(journal)})
+
+    def update(self, token, numbers, summaries, formats, journal=None):
+        # Only the journal moved on; the token file is still the one the entry was built from.
+        entry = dict(self.index['tokens'][token], journal=journal_fingerprint(journal))
+        self.put(token, self.write_columns(token, numbers, summaries, formats, entry))
+        self.save_index()
+
+    def append(self, token, ops, journal=None):
+        # Ops that all add at the end of their series: only their rows are written,
+        # into the room after each column. False, with nothing written, if they
+        # don't fit or the file is not the one the entry describes.
+        entry = self.index['tokens'][token]
+        series = dict(entry['series'])
+        raw = dict(entry['raw'])
+        slots = entry['slots']
+        added = []
+        for op in ops:
+            key = f"{op['g']}.{op['c']}"
+            offset, count, room = series[key]
+            if op['op'] == 'remove' or op.get('i', count) != count or count == room:
+                return False
+            errors = []
+            values = [parse_values([op['p'][axis]], 'xy'[axis], errors)[0] for axis in (0, 1)]
+            kinds = [value_kind(op['p'][axis], values[axis]) for axis in (0, 1)]
+            raw[key] = raw.get(key, []) + [[count, axis, op['p'][axis]] for axis in (0, 1) if kinds[axis] == KIND_RAW]
+            added.append((key, count, values, kinds, errors, op['p']))
+            series[key] = (offset, count + 1, room)
+        with open(f'{self.path}/{token}.f64', 'r+b') as f:
+            if file_identity(f.fileno()) != entry['columns']:
+                return False
+            for key, i, values, kinds, _, _ in added:
+                offset, _, room = series[key]
+                for axis, start in enumerate((offset, offset + room)):
+                    f.seek(8 * (start + i))
+                    array('d', [values[axis]]).tofile(f)
+                    f.seek(8 * slots + start + i)
+                    f.write(bytes([kinds[axis]]))
+            f.flush()
+            entry = dict(entry, series=series, columns=file_identity(f.fileno()), raw={k: v for k, v in raw.items() if v},
+                         journal=journal_fingerprint(journal), summaries=dict(entry['summaries']))
+        self.put(token, entry)
+        numbers, summaries = self.read(token)
+        for key, i, _, _, errors, point in added:
+            xs, ys = numbers[key]
+            summaries[key] = dict(summaries[key], last_raw=Series([point])[0])
+            summarize_insert(xs[:i+1], ys[:i+1], summaries[key], i, errors)
+        self.save_index()
+        return True
+
+    def reload_index(self):
+        # entries other runs saved since the index was read, taken between saves only
+        if not self.dirty:
+            self.index = self.read_index()
+
+    def restamp(self, token, file, journal=None):
+        # The token file was rewritten with the points the entry already describes.
+        size, mtime_ns = token_stat(file)
+        self.index['tokens'][token].update({
+            'size': size, 'mtime_ns': mtime_ns, 'blob': git_blob_hash(read_token(file)),
+            'journal': journal_fingerprint(journal)})
+        self.dirty.add(token)
+        self.save_index()
+
+    def write_columns(self, token, numbers, summaries, formats, entry):
+        columns = array('d')
+        kinds = bytearray()
+        series = {}
+        raw = {}
+        for key, (xs, ys) in numbers.items():
+            room = len(xs) + len(xs) // 8 + 16
+            series[key] = (len(columns), len(xs), room)
+            for column, column_kinds in zip((xs, ys), formats[key]):
+                columns.frombytes(memoryview(column).cast('B'))
+                columns.frombytes(bytes(8 * (room - len(column))))
+                kinds += column_kinds
+                kinds += bytes(room - len(column))
+            if formats[key][2]:
+                raw[key] = formats[key][2]
+        os.makedirs(self.path, exist_ok=True)
+        with open(f'{self.path}/{token}.f64.{os.getpid()}.tmp', 'wb') as f:
+            columns.tofile(f)
+            f.write(kinds)
+            f.flush()
+            entry['columns'] = file_identity(f.fileno())
+        os.replace(f'{self.path}/{token}.f64.{os.getpid()}.tmp', f'{self.path}/{token}.f64')
+        entry['series'] = series
+        entry['slots'] = len(columns)
+        entry['raw'] = raw
+        entry['summaries'] = summaries
+        return entry
+
+    def rebuild(self, graphs):
+        self.index = self.new_index()
+        for token in graphs.keys():
+            self.write(token, graphs.files[token], graphs[token], graphs.journal_file(token))
+
+    def print_stats(self, graphs):
+        tokens = self.load_index()['tokens']
+        valid = [t for t in graphs.keys() if graphs.cache_is_valid(t)]
+        series = sum(len(tokens[t]['series']) for t in valid)
+        points = sum(count for t in valid for _, count, _ in tokens[t]['series'].values())
+        size = 0
+        for t in tokens.keys():
+            if os.path.exists(f'{self.path}/{t}.f64'):
+                size += os.path.getsize(f'{self.path}/{t}.f64')
+        print(f'Series cache: {self.path}')
+        print(f'  tokens:  {len(valid)} valid / {len(graphs)} total ({len(tokens) - len(valid)} stale)')
+        print(f'  series:  {series}')
+        print(f'  points:  {points}')
+        print(f'  size:    {size} bytes')
+        print(f'  this run: {self.hits} hits, {self.misses} rebuilt')
+
+
+def git_blob_hash(raw):
+    return hashlib.sha1(b'blob %d\0' % len(raw) + raw).hexdigest()
+
+
+def token_numbers(data, summaries=None, formats=None):
+    numbers = {}
+    for g in data.keys():
+        for c in data[g].keys():
+            points = data[g][c]
+            if isinstance(points, Series):
+                xs, ys, errors = points.xs, points.ys, points.errors()
+            elif formats is not None:
+                points = Series(points)
+                xs, ys, errors = points.xs, points.ys, points.errors()
+            else:
+                errors = []
+                xs = parse_values([p[0] for p in points], 'x', errors)
+                ys = parse_values([p[1] for p in points], 'y', errors)
+            numbers[f'{g}.{c}'] = (xs, ys)
+            if summaries is not None:
+                summaries[f'{g}.{c}'] = summarize_series(points, xs, ys, errors)
+            if formats is not None:
+                formats[f'{g}.{c}'] = series_formats(points)
+    return numbers
+
+
+def series_formats(points):
+    # A kind per value of each axis and the raw values, the way the cache keeps them.
+    kinds = []
+    for axis_kinds in points.kinds:
+        if isinstance(axis_kinds, int):
+            kinds.append(bytes([axis_kinds]) * len(points))
+        else:
+            kinds.append(axis_kinds or b'')
+    return kinds[0], kinds[1], [[i, axis, v] for (i, axis), v in sorted(points.raw.items())]
+
+
+def summarize_series(points, xs, ys, errors):
+    summary = {
+        'count': len(xs),
+        'last_raw': points[-1] if points else None,
+        'errors': sorted(errors, key=lambda e: e['index']),
+        # NaN never compares equal, so series with unparsed x values count as unsorted
+        'sorted': list(xs) == sorted(xs),
+    }
+    series_bounds(summary, xs, ys)
+    series_ends(summary, xs, ys)
+    return summary
+
+
+def series_bounds(summary, xs, ys):
+    xs, ys = window_points(xs, ys, summary)
+    summary['min_x'] = min(xs) if len(xs) else None
+    summary['max_x'] = max(xs) if len(xs) else None
+    summary['min_y'] = min(ys) if len(ys) else None
+    summary['max_y'] = max(ys) if len(ys) else None
+
+
+def series_ends(summary, xs, ys):
+    valid = lambda i: not math.isnan(xs[i]) and not math.isnan(ys[i])
+    first = next((i for i in range(len(xs)) if valid(i)), None)
+    last = next((i for i in range(len(xs)-1, -1, -1) if valid(i)), None)
+    summary['first'] = [xs[first], ys[first]] if first is not None else None
+    summary['last'] = [xs[last], ys[last]] if last is not None else None
+    summary['x_is_date'] = len(xs) > 0 and xs[-1] > 1700000000
+    summary['total_delta'] = None
+    summary['year_est'] = None
+    if first is not None and xs[first] != xs[last]:
+        first_x, first_y = [epoch_to_days(v) for v in summary['first']]
+        last_x, last_y = [epoch_to_days(v) for v in summary['last']]
+        summary['total_delta'] = (last_y - first_y)/(last_x - first_x)
+        if summary['x_is_date']:
+            summary['year_est'] = summary['total_delta'] * 365 * 100
+
+
+def apply_series_op(xs, ys, summary, op, points=None):
+    # Keeps cached columns and their summary in step with one journal op, and
+    # points, a Series over the same columns, when given. Only removing a
+    # bounding point (or from an unsorted series) rescans the series.
+    if op['op'] == 'remove':
+        i = op['i']
+        x, y = xs[i], ys[i]
+        if points is None:
+            del xs[i], ys[i]
+        else:
+            del points[i]
+        summary['errors'] = [e if e['index'] < i else dict(e, index=e['index'] - 1)
+                             for e in summary['errors'] if e['index'] != i]
+        if not summary['sorted']:
+            summary['sorted'] = list(xs) == sorted(xs)
+        if x in (summary['min_x'], summary['max_x']) or y in (summary['min_y'], summary['max_y']):
+            series_bounds(summary, xs, ys)
+        summary['count'] = len(xs)
+        series_ends(summary, xs, ys)
+    else:
+        i = op['i'] if op['op'] == 'insert' else len(xs)
+        errors = []
+        x = parse_values([op['p'][0]], 'x', errors)[0]
+        y = parse_values([op['p'][1]], 'y', errors)[0]
+        if points is None:
+            xs.insert(i, x)
+            ys.insert(i, y)
+        else:
+            points.insert(i, op['p'])
+        summarize_insert(xs, ys, summary, i, errors)
+
+
+def summarize_insert(xs, ys, summary, i, errors):
+    # The summary of columns that just got the point at i, without rescanning them.
+    x, y = xs[i], ys[i]
+    summary['errors'] = sorted([e if e['index'] < i else dict(e, index=e['index'] + 1) for e in summary['errors']]
+                               + [dict(e, index=i) for e in errors], key=lambda e: e['index'])
+    if summary['sorted']:
+        summary['sorted'] = not math.isnan(x) and (i == 0 or xs[i-1] <= x) and (i == len(xs)-1 or x <= xs[i+1])
+    if not math.isnan(x) and not math.isnan(y):
+        if summary['min_x'] is None:
+            summary.update({'min_x': x, 'max_x': x, 'min_y': y, 'max_y': y})
+        else:
+            summary.update({'min_x': min(summary['min_x'], x), 'max_x': max(summary['max_x'], x),
+                            'min_y': min(summary['min_y'], y), 'max_y': max(summary['max_y'], y)})
+    summary['count'] = len(xs)
+    series_ends(summary, xs, ys)
+
+
+def get_graphs(dp, workers=None):
+    path = os.path.dirname(os.path.realpath(__file__))
+    return GraphStore(dp, SeriesCache(path + "/pUD_cache"), path + "/pUD_journal", path + "/pUD_index.json", workers)
 
 def list_graphs(graphs, selection, info=False):
-    graph_index = 0
-    for t in graphs.keys():
+    tree = graphs.index.tree
+    if info and graphs.cache is not None:
+        graphs.warm(list(tree.keys()))
+    for t in tree.keys():
         print(t)
-        for g in graphs[t].keys():
+        for g in tree[t].keys():
             print("  - " + g)
-            for c in graphs[t][g].keys():
+            for c, graph_index in tree[t][g].items():
                 mark = " -"
                 if selection == f'{t}.{g}.{c}':
                     mark = "->"
                 infos = ''
                 if info:
-                    infos = f'   |   Points:{len(graphs[t][g][c]): >4}'
-                    if len(graphs[t][g][c]) > 0:
-                        infos += f'   |   Last:  x: {str(graphs[t][g][c][-1][0]): >20}  y: {str(graphs[t][g][c][-1][1]): >20}'
+                    summary = graphs.series_summary(t, g, c)
+                    infos = f'   |   Points:{summary["count"]: >4}'
+                    if summary['count'] > 0:
+                        last = summary['last_raw']
+                        infos += f'   |   Last:  x: {str(last[0]): >20}  y: {str(last[1]): >20}'
                 print(f'     {mark} {"["+str(graph_index)+"]": <4} {c: <20}{infos}')
-
-
-                graph_index += 1
     return True
 
 
 def graph_by_index(graphs, i):
-    graph_index = 0
-    for t in graphs.keys():
-        for g in graphs[t].keys():
-            l = len(graphs[t][g].keys())
-            if graph_index + l > i:
-                return True, t, g, list(graphs[t][g].keys())[i - graph_index]
-            graph_index += l
+    entries = graphs.index.entries
+    if 0 <= i < len(entries):
+        return True, *entries[i].split(".")
     return False, '', '', ''
 
 def select_graph(graphs, selection, status):
-    t = ""
-    g = ""
-    c = ""
+    index = graphs.index
     if len(selection) > 0:
-        tlist = list(map(str.lower, graphs.keys()))
-        stoken = selection[0].lower()
-        if stoken in tlist:
-            t = list(graphs.keys())[tlist.index(stoken)]
+        t = index.lookup(selection[0])
+        if t:
+            tg = ""
             if len(selection) > 1:
-                glist = list(map(str.lower, graphs[t].keys()))
-                sgraph = selection[1].lower()
-                if sgraph in glist:
-                    g = list(graphs[t].keys())[glist.index(sgraph)]
-                else:
+                tg = index.lookup(t, selection[1]) or ""
+                if tg == "":
                     print(f'Token {t} has no graph {selection[1]}')
-                    if len(graphs[t].keys()) > 0:
-                        print(f'Please select a GRAPH from {graphs[t].keys()} by using {t}.GRAPH as identifier')
-            elif len(graphs[t].keys()) == 1:
-                g = list(graphs[t].keys())[0]
+                    if len(index.tree[t].keys()) > 0:
+                        print(f'Please select a GRAPH from {index.tree[t].keys()} by using {t}.GRAPH as identifier')
+            elif index.defaults[t]:
+                tg = index.defaults[t]
             else:
                 print('Could not select graph by default value.')
-                if len(graphs[t].keys()) > 1:
-                    print(f'Please select a GRAPH from {graphs[t].keys()} by using {t}.GRAPH as identifier')
-            if g != "":
+                if len(index.tree[t].keys()) > 1:
+                    print(f'Please select a GRAPH from {index.tree[t].keys()} by using {t}.GRAPH as identifier')
+            if tg != "":
+                g = tg.split(".")[1]
+                tgc = ""
                 if len(selection) > 2:
-                    clist = list(map(str.lower, graphs[t][g].keys()))
-                    schain = selection[2].lower()
-                    if schain in clist:
-                        c = list(graphs[t][g].keys())[clist.index(schain)]
-                    else:
+                    tgc = index.lookup(tg, selection[2]) or ""
+                    if tgc == "":
                         print(f'Graph {t}.{g} has no chain {selection[0]}')
-                        if len(graphs[t][g].keys()) > 0:
-                            print(f'Please select a GRAPH from {graphs[t][g].keys()} by using {t}.{g}.CHAIN as identifier')
-                elif len(graphs[t].keys()) == 1:
-                    c = list(graphs[t][g].keys())[0]
-                elif 'global' in graphs[t][g].keys():
-                    c = 'global'
+                        if len(index.tree[t][g].keys()) > 0:
+                            print(f'Please select a GRAPH from {index.tree[t][g].keys()} by using {t}.{g}.CHAIN as identifier')
+                elif index.defaults[tg]:
+                    tgc = index.defaults[tg]
                 else:
                     print('Could not select chain by default value.')
-                    if len(graphs[t].keys()) >= 1:
-                        print(f'Please select a CHAIN from {graphs[t][g].keys()} by using {t}.{g}.CHAIN as identifier')
-                if c != "":
-                    status['selected'] = f'{t}.{g}.{c}'
-                    set_status(status, "selected", f'{t}.{g}.{c}')
+                    if len(index.tree[t].keys()) >= 1:
+                        print(f'Please select a CHAIN from {index.tree[t][g].keys()} by using {t}.{g}.CHAIN as identifier')
+                if tgc != "":
+                    set_status(status, "selected", tgc)
                     return True
         else:
             print(f'Data for token "{selection[0]}" not found!')
@@ -187,10 +1502,84 @@ def select_graph(graphs, selection, status):
 
 def set_status(status, param, value):
     status[param] = value
-    save_status(status)
+
+
+_profile = {'enabled': False, 'hooked': False, 'phases': [], 'current': None, 'subprocesses': 0}
+
+def start_profile():
+    if not _profile['hooked']:
+        sys.addaudithook(count_subprocesses)
+        _profile['hooked'] = True
+    _profile.update({'enabled': True, 'phases': [], 'current': None, 'subprocesses': 0})
+    start_phase('startup')
+
+
+def count_subprocesses(event, args):
+    if event == 'subprocess.Popen' and _profile['enabled']:
+        _profile['subprocesses'] += 1
+
+
+def profile_sample():
+    # Only the wall clock is read unless --profile is on, durations go to action_history either way.
+    sample = {'wall': time.perf_counter()}
+    if _profile['enabled']:
+        times = os.times()
+        sample.update({'cpu': time.process_time(), 'child_cpu': times.children_user + times.children_system,
+                       'subprocesses': _profile['subprocesses'], 'read': 0, 'written': 0})
+        if os.path.exists('/proc/self/io'):
+            with open('/proc/self/io') as f:
+                io_counters = dict(line.split(': ') for line in f.read().splitlines())
+            sample['read'] = int(io_counters['rchar'])
+            sample['written'] = int(io_counters['wchar'])
+    return sample
+
+
+def start_phase(action, param=None):
+    end_phase()
+    _profile['current'] = {'name': action, 'param': param, 'start': profile_sample()}
+
+
+def end_phase():
+    phase = _profile['current']
+    _profile['current'] = None
+    if phase and _profile['enabled']:
+        phase['end'] = profile_sample()
+        _profile['phases'].append(phase)
+
+
+def phase_duration():
+    if _profile['current']:
+        return time.perf_counter() - _profile['current']['start']['wall']
+    return None
+
+
+def print_profile(trace_file=''):
+    rows = []
+    for phase in _profile['phases']:
+        start, end = phase['start'], phase['end']
+        rows.append([phase['name']] + [end[k] - start[k] for k in ('wall', 'cpu', 'child_cpu', 'subprocesses', 'read', 'written')])
+    if not rows:
+        return
+    total = ['total'] + [sum(r[i] for r in rows) for i in range(1, 7)]
+    lines = [f'{"phase": <18} {"wall ms": >9} {"cpu ms": >9} {"child ms": >9} {"procs": >6} {"read B": >10} {"written B": >10}']
+    for r in rows + [total]:
+        lines.append(f'{r[0]: <18} {1000*r[1]: >9.2f} {1000*r[2]: >9.2f} {1000*r[3]: >9.2f} {r[4]: >6} {r[5]: >10} {r[6]: >10}')
+    sys.stderr.write("\n".join(lines) + "\n")
+    if trace_file:
+        origin = _profile['phases'][0]['start']['wall']
+        events = []
+        for phase, r in zip(_profile['phases'], rows):
+            events.append({'name': phase['name'], 'cat': 'pUD', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                           'ts': int((phase['start']['wall'] - origin) * 1e6), 'dur': int(r[1] * 1e6),
+                           'args': {'param': phase['param'], 'cpu_ms': 1000*r[2], 'child_cpu_ms': 1000*r[3],
+                                    'subprocesses': r[4], 'read': r[5], 'written': r[6]}})
+        with open(trace_file, 'w') as f:
+            f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+        sys.stderr.write(f'Trace written to {trace_file}\n')
 
 
 def set_pending_action(status, action, param=None):
+    start_phase(action, param)
     crash_rep = {'action': action}
     if param:
         crash_rep['param'] = param
@@ -198,23 +1587,28 @@ def set_pending_action(status, action, param=None):
         crash_rep['cmd'] = ' '.join(sys.argv)
     crash_rep['timestamp'] = time.time()
     status['crash_on'] = crash_rep
-    save_status(status)
+    path = os.path.dirname(os.path.realpath(__file__))
+    write_atomic(f'{path}/pUD_pending.{os.getpid()}.json', json.dumps(crash_rep))
 
 def clear_crash_rep(status):
     if 'crash_on' in status:
         del status['crash_on']
-        save_status(status)
+    path = os.path.dirname(os.path.realpath(__file__))
+    if os.path.exists(f'{path}/pUD_pending.{os.getpid()}.json'):
+        os.remove(f'{path}/pUD_pending.{os.getpid()}.json')
 
 
 def add_action_history(status, action, success=True, param=None):
     if param is None:
         param = {}
     update = {'type': action, 'success': success, **param, 'timestamp': time.time()}
+    duration = phase_duration()
+    if duration is not None:
+        update['duration'] = round(duration, 4)
     status['action_history'].insert(0,update)
     del status['crash_on']
     if len(status['action_history']) > 10:
         status['action_history'].pop()
-    save_status(status)
 
 
 def select_graph_by_index(graphs, index, status):
@@ -225,11 +1619,8 @@ def select_graph_by_index(graphs, index, status):
     set_status(status, "selected", '')
     return False
 
-def add_to_data(point, to, status):
+def add_to_data(graphs, point, to, status):
     gp = status['selected'].split(".")
-    file = status['datapath'] + "/" + gp[0] +".json"
-    with open(file) as f:
-        data = json.load(f)
     timenow = datetime.fromtimestamp(int(time.time()), timezone.utc).strftime(TIME_FORMAT)
     if point[0].lower() == 'now':
         point[0] = timenow
@@ -259,87 +1650,336 @@ def add_to_data(point, to, status):
 
     point[0] = string_number_to_number(point[0])
     point[1] = string_number_to_number(point[1])
-    if not to:
-        data[gp[1]][gp[2]].append(point)
+    if status['selected'] in status.get('ordered', []) and to:
+        print(f'{status["selected"]} is kept ordered by x, datapoints can not be added to an index')
+        return False
+    if status['selected'] not in status.get('ordered', []) and not to:
+        # goes after whatever the series holds by then, so no retries and no loading
+        if graphs.append(gp[0], gp[1], gp[2], point):
+            print(f'Added datapoint {point[0]}, {point[1]} to {gp[0]}.{gp[1]}.{gp[2]}')
+            return True
+        print(f'{gp[0]} kept changing while adding, nothing was added')
+        return False
+    # the position is worked out again if another run changed the token first, under
+    # its lock so appends from other runs, quicker than loading it, can't keep it busy
+    with graphs.lock(gp[0]):
+        for _ in range(WRITE_RETRIES):
+            if status['selected'] in status.get('ordered', []):
+                if not graphs.series_summary(gp[0], gp[1], gp[2])['sorted']:
+                    print(f'{status["selected"]} is no longer sorted by x, use --ordered on to sort it again')
+                    return False
+            points = graphs[gp[0]][gp[1]][gp[2]]
+            if status['selected'] in status.get('ordered', []):
+                # bisect the loaded revision itself, the cache may already be newer
+                xs = points.xs
+                x = parse_value(point[0])
+                i = bisect_right(xs, x)
+                if i > 0 and xs[i-1] == x:
+                    print(f'{status["selected"]} already has a datapoint at x {point[0]} (#{i-1})')
+                    return False
+            else:
+                i = to[0]
+                if i < 0 or i >= len(points):
+                    print("Can't add! Index out of range!")
+                    return False
+            points.insert(i, point)
+            if graphs.log(gp[0], [{'op': 'insert', 'g': gp[1], 'c': gp[2], 'i': i, 'p': point}]):
+                print(f'Added datapoint {point[0]}, {point[1]} to {gp[0]}.{gp[1]}.{gp[2]}')
+                return True
+    print(f'{gp[0]} kept changing while adding, nothing was added')
+    return False
+
+
+def find_graph(graphs, identifier):
+    # Case-insensitive TOKEN.GRAPH?.CHAIN? lookup with select_graph's defaults, without side effects.
+    index = graphs.index
+    found = index.lookup(identifier)
+    while found and found.count(".") < 2:
+        found = index.defaults[found]
+    return found or ''
+
+
+def read_datapoint_rows(f):
+    # Rows are "X,Y" / "TOKEN.GRAPH.CHAIN,X,Y" CSV lines or NDJSON lines holding
+    # [X, Y], [SERIES, X, Y] or {"x": X, "y": Y, "series": SERIES}.
+    first = True
+    for lineno, line in enumerate(f, 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        header = first
+        first = False
+        if stripped[0] in '[{':
+            try:
+                row = json.loads(stripped)
+            except ValueError:
+                yield lineno, None
+                continue
+            if isinstance(row, dict):
+                row = [row['series'], row.get('x'), row.get('y')] if 'series' in row else [row.get('x'), row.get('y')]
+        else:
+            row = next(csv.reader([stripped]))
+            if header and [v.strip().lower() for v in row] in (['x', 'y'], ['series', 'x', 'y']):
+                continue
+        if not isinstance(row, list) or len(row) not in (2, 3):
+            yield lineno, None
+            continue
+        if len(row) == 2:
+            row = [''] + row
+        yield lineno, [v.strip() if isinstance(v, str) else v for v in row]
+
+
+def add_from_file(graphs, source, status):
+    if source == '-':
+        rows = list(read_datapoint_rows(sys.stdin))
     else:
-        to = to[0]
-        if to < 0 or to >= len(data[gp[1]][gp[2]]):
-            print("Can't add! Index out of range!")
+        with open(source) as f:
+            rows = list(read_datapoint_rows(f))
+    timenow = datetime.fromtimestamp(int(time.time()), timezone.utc).strftime(TIME_FORMAT)
+    problems = []
+    points = []
+    resolved = {}
+    for lineno, row in rows:
+        if row is None:
+            problems.append((lineno, 'expected X,Y or SERIES,X,Y'))
+            continue
+        series = row[0] or status['selected']
+        if series not in resolved:
+            resolved[series] = find_graph(graphs, series) if series else ''
+        if not resolved[series]:
+            problems.append((lineno, f'no such graph "{series}"' if series else 'no graph selected'))
+            continue
+        x, y = [timenow if isinstance(v, str) and v.lower() == 'now' else v for v in row[1:]]
+        points.append((lineno, resolved[series], x, y))
+    errors = []
+    xs = parse_values([p[2] for p in points], 'x', errors)
+    parse_values([p[3] for p in points], 'y', errors)
+    for e in errors:
+        problems.append((points[e['index']][0], f'could not parse {e["axis"]} value {e["value"]!r}'))
+    for lineno, _, _, y in points:
+        if isinstance(y, str) and is_timestamp(y):
+            problems.append((lineno, f'time value {y!r} on Y axis'))
+    if problems:
+        for lineno, problem in sorted(problems):
+            print(f'line {lineno}: {problem}')
+        print(f'Nothing added. Please use number, timestamp ({TIME_FORMAT}) or "NOW" for X and a number for Y')
+        return False, {}
+    added = {}
+    rows = list(zip(points, xs))
+    # tokens another run changed in between are placed again on their current points
+    for _ in range(WRITE_RETRIES):
+        positions, problems = ordered_positions(graphs, rows, status)
+        if problems:
+            for lineno, problem in sorted(problems):
+                print(f'line {lineno}: {problem}')
+            if added:
+                print('The other datapoints were not added.')
+            else:
+                print(f'Nothing added. Please use number, timestamp ({TIME_FORMAT}) or "NOW" for X and a number for Y')
+            break
+        ops = {}
+        for ((_, series, x, y), _), i in zip(rows, positions):
+            gp = series.split(".")
+            point = [string_number_to_number(x), string_number_to_number(y)]
+            series_points = graphs[gp[0]][gp[1]][gp[2]]
+            if i is None:
+                series_points.append(point)
+                ops.setdefault(gp[0], []).append({'op': 'add', 'g': gp[1], 'c': gp[2], 'p': point})
+            else:
+                series_points.insert(i, point)
+                ops.setdefault(gp[0], []).append({'op': 'insert', 'g': gp[1], 'c': gp[2], 'i': i, 'p': point})
+        changed = [token for token, token_ops in ops.items() if not graphs.log(token, token_ops)]
+        for (_, series, _, _), _ in rows:
+            if series.split(".")[0] not in changed:
+                added[series] = added.get(series, 0) + 1
+        rows = [row for row in rows if row[0][1].split(".")[0] in changed]
+        if not rows:
+            break
+    else:
+        print(f'{", ".join(changed)} kept changing while adding, {len(rows)} datapoint(s) were not added')
+    for series, count in added.items():
+        print(f'Added {count} datapoint(s) to {series}')
+    return not rows, added
+
+
+def ordered_positions(graphs, rows, status):
+    # ordered graphs get each point at its x position, tracked on a copy of their x column
+    positions = []
+    problems = []
+    columns = {}
+    ordered = [(lineno, series) for (lineno, series, _, _), x in rows
+               if series in status.get('ordered', []) and not math.isnan(x)]
+    # summaries first, they may drop a token that changed on disk before its points are loaded
+    for lineno, series in ordered:
+        if series not in columns:
+            gp = series.split(".")
+            columns[series] = graphs.series_summary(gp[0], gp[1], gp[2])['sorted']
+            if not columns[series]:
+                columns[series] = None
+                problems.append((lineno, f'{series} is no longer sorted by x, use --ordered on to sort it again'))
+    for series, sorted_x in columns.items():
+        if sorted_x:
+            # the loaded revision, which the inserts are checked against when logged
+            gp = series.split(".")
+            columns[series] = array('d', graphs[gp[0]][gp[1]][gp[2]].xs.tobytes())
+    for (lineno, series, x_value, _), x in rows:
+        positions.append(None)
+        if series not in status.get('ordered', []) or math.isnan(x):
+            continue
+        column = columns[series]
+        if column is None:
+            continue
+        i = bisect_right(column, x)
+        if i > 0 and column[i-1] == x:
+            problems.append((lineno, f'{series} already has a datapoint at x {x_value!r}'))
+            continue
+        column.insert(i, x)
+        positions[-1] = i
+    return positions, problems
+
+
+def set_ordered(graphs, on, status):
+    # Local to this machine: a graph others appended out of order is caught
+    # when adding here and has to be sorted again with --ordered on.
+    series = status['selected']
+    ordered = status.setdefault('ordered', [])
+    if not on:
+        if series in ordered:
+            ordered.remove(series)
+        print(f'{series} is no longer kept ordered by x')
+        return True
+    gp = series.split(".")
+    summary = graphs.series_summary(gp[0], gp[1], gp[2])
+    errors = [e for e in summary['errors'] if e['axis'] == 'x']
+    if errors:
+        print(f"Can't order {series} by x:")
+        print("\n".join(parse_error_lines(errors)))
+        return False
+    # held while sorting, so appends from other runs wait instead of making it start over
+    with graphs.lock(gp[0]):
+        for _ in range(WRITE_RETRIES):
+            summary = graphs.series_summary(gp[0], gp[1], gp[2])
+            if summary['sorted']:
+                xs, _ = graphs.series_numbers(gp[0], gp[1], gp[2])
+                break
+            points = graphs[gp[0]][gp[1]][gp[2]]
+            order = sorted(range(len(points)), key=points.xs.__getitem__)
+            points.reorder(order)
+            if graphs.save(gp[0]):
+                xs = points.xs
+                print(f'Sorted {len(points)} datapoint(s) of {series} by x')
+                break
+            # someone else wrote the token, sort what is there now
+        else:
+            print(f'{gp[0]} kept changing while sorting, {series} was not sorted')
             return False
-        data[gp[1]][gp[2]] = data[gp[1]][gp[2]][:to] + [point] + data[gp[1]][gp[2]][to:]
-    with open(file, 'w') as f:
-        f.write(json.dumps(data, indent=2))
-    print(f'Added datapoint {point[0]}, {point[1]} to {gp[0]}.{gp[1]}.{gp[2]}')
+    duplicates = sum(1 for i in range(1, len(xs)) if xs[i] == xs[i-1])
+    if duplicates:
+        print(f'Warning: {duplicates} datapoint(s) of {series} repeat the x value before them')
+    if series not in ordered:
+        ordered.append(series)
+    print(f'{series} is kept ordered by x')
     return True
 
 
-def remove_from_data(index, status):
+def remove_from_data(graphs, index, status):
     gp = status['selected'].split(".")
-    file = status['datapath'] + "/" +  gp[0] +".json"
-    with open(file) as f:
-        data = json.load(f)
-    data_len = len(data[gp[1]][gp[2]])
-    if index < -data_len or index >= data_len:
-        print("Can't delete! No such datapoint!")
-        return False
-    dp = data[gp[1]][gp[2]][index][:]
-    del data[gp[1]][gp[2]][index]
-    with open(file, 'w') as f:
-        f.write(json.dumps(data, indent=2))
-    print("Datapoint deleted!")
-    if index < 0:
-        index = data_len + index
-    print(f'Removed datapoint #{str(index)} ({str(dp[0])}, {str(dp[1])}) from {gp[0]}.{gp[1]}.{gp[2]}')
+    # held across the retries, appends from other runs are quicker than loading the token
+    with graphs.lock(gp[0]):
+        for _ in range(WRITE_RETRIES):
+            data = graphs[gp[0]]
+            data_len = len(data[gp[1]][gp[2]])
+            if index < -data_len or index >= data_len:
+                print("Can't delete! No such datapoint!")
+                return False
+            i = data_len + index if index < 0 else index
+            dp = data[gp[1]][gp[2]][i]
+            del data[gp[1]][gp[2]][i]
+            if graphs.log(gp[0], [{'op': 'remove', 'g': gp[1], 'c': gp[2], 'i': i}]):
+                print("Datapoint deleted!")
+                print(f'Removed datapoint #{str(i)} ({str(dp[0])}, {str(dp[1])}) from {gp[0]}.{gp[1]}.{gp[2]}')
+                return True
+    print(f'{gp[0]} kept changing while removing, nothing was removed')
+    return False
+
+def epoch_to_days(v):
+    if v > 1700000000: # assume epoc
+        return v/(60*60*24)
+    return v
+
+
+def series_view(graphs, selected):
+    # What -d and -p render: a stored graph here, or a --combine result.
+    gp = selected.split(".")
+    points = graphs.series_points(gp[0], gp[1], gp[2])
+    return {'name': selected, 'title': f'{gp[0]} {gp[1]} on {gp[2]}', 'points': points,
+            'xs': points.xs, 'ys': points.ys, 'summary': graphs.series_summary(gp[0], gp[1], gp[2]),
+            'errors': graphs.series_errors(gp[0], gp[1], gp[2])}
+
+
+def show_graph_data(graphs, status, x_range=None, rows=None, head=None, tail=None, view=None):
+    view = view or series_view(graphs, status['selected'])
+    sys.stdout.write("\n".join(data_lines(view, x_range, rows, head, tail)) + "\n")
     return True
 
-def show_graph_data(graphs, status):
-    gp = status['selected'].split(".")
-    datapoints = graphs[gp[0]][gp[1]][gp[2]]
-    i = 0
-    print(f'Data for {gp[0]}.{gp[1]}.{gp[2]}')
-    first_x = ""
-    first_y = ""
+
+def data_lines(view, x_range=None, rows=None, head=None, tail=None):
+    datapoints = view['points']
+    xs, ys = view['xs'], view['ys']
+    summary = view['summary']
+    lo, hi = series_window(xs, summary, x_range)
+    if rows:
+        # negative indexes count from the end, as -r does
+        lo = max(lo, rows[0] + len(xs) if rows[0] < 0 else rows[0])
+        hi = min(hi, (rows[1] + len(xs) if rows[1] < 0 else rows[1]) + 1)
+    indices = range(lo, hi)
+    if x_range and not summary['sorted']:
+        indices = [i for i in indices if in_range(xs[i], x_range)]
+    if head is not None:
+        indices = indices[:head]
+    if tail is not None:
+        indices = indices[len(indices)-tail:] if tail < len(indices) else indices
+    lines = [f'Data for {view["name"]}']
+    # deltas of the first shown point are taken against the last valid point before the window
     last_x = ""
     last_y = ""
-    is_x_dates = False
-    for datapoint in datapoints:
-        x, y = datapoint_to_numbers(datapoint)
-        if x > 1700000000: # assume epoc
-            is_x_dates = True
-            x = x/(60*60*24)
-        else:
-            is_x_dates = False
-        if y > 1700000000: # assume epoc
-            y = y/(60*60*24)
+    for i in range(indices[0]-1 if indices else -1, -1, -1):
+        if not math.isnan(xs[i]) and not math.isnan(ys[i]):
+            last_x = epoch_to_days(xs[i])
+            last_y = epoch_to_days(ys[i])
+            break
+    for i in indices:
+        x = epoch_to_days(xs[i])
+        y = epoch_to_days(ys[i])
         deltas = ""
-        if x != "ERROR" and y != "ERROR":
-            if first_x == "":
-                first_x = x
-                first_y = y
-            else:
-                d = (y - last_y)/(x - last_x)
+        if not math.isnan(x) and not math.isnan(y):
+            if last_x != "":
                 dx = f'{100*(x - last_x):.3f}%'
                 dy = f'{100*(y - last_y):.3f}%'
                 deltas = f'  |  delta: x: {dx: >20} y: {dy: >20}'
-
             last_x = x
             last_y = y
+        lines.append(f'{i: >3}. x: {datapoints.value(i, 0): >20}     y: {datapoints.value(i, 1): >20}{deltas}')
 
-        if isinstance(datapoint, list):
-            print(f'{i: >3}. x: {datapoint[0]: >20}     y: {datapoint[1]: >20}{deltas}')
-        else:
-            print(f'{i: >3}. x: {datapoint.x: >20}     y: {datapoint.y: >20}{deltas}')
-        i += 1
-
-    if first_x != "" and last_x != "":
-        delta = (last_y - first_y)/(last_x - first_x)
-        deltas = f'{100*delta:.3f}%'
+    if summary['total_delta'] is not None:
+        deltas = f'{100*summary["total_delta"]:.3f}%'
         td = f'{"": >54} total delta: {deltas: >20}'
-        if is_x_dates:
-            y_est = delta * 365 * 100
-            td += f'  |  Year est:  {y_est:.3f}%'
-        print(td)
-    return True
+        if summary['year_est'] is not None:
+            td += f'  |  Year est:  {summary["year_est"]:.3f}%'
+        lines.append(td)
+    lines += parse_error_lines(view['errors'])
+    return lines
+
+
+def parse_error_lines(errors):
+    lines = []
+    if errors:
+        lines.append(f'Could not parse {len(errors)} value(s):')
+        for e in errors[:5]:
+            lines.append(f'  #{e["index"]} {e["axis"]}: {e["value"]!r}')
+        if len(errors) > 5:
+            lines.append(f'  ...')
+    return lines
 
 def is_int(n):
     try:
@@ -360,83 +2000,575 @@ def is_float(n):
 
 def is_timestamp(n):
     try:
-        datetime.strptime(n, TIME_FORMAT)
-    except ValueError:
-        print("error")
+        timestamp_to_number(n)
+    except (ValueError, TypeError):
         return False
     else:
         return True
 
-def plot_graph_data(graphs, status):
-    gp = status['selected'].split(".")
-    datapoints = graphs[gp[0]][gp[1]][gp[2]]
-    max_x = "unset"
-    max_y = "unset"
-    min_x = "unset"
-    min_y = "unset"
-    data = []
-    for datapoint in datapoints:
-        x, y = datapoint_to_numbers(datapoint)
-        if x == "ERROR" or y == "ERROR":
-            continue
-        data.append([x,y])
-        if max_x == "unset" or x > max_x:
-            max_x = x
-        if min_x == "unset" or x < min_x:
-            min_x = x
-        if max_y == "unset" or y > max_y:
-            max_y = y
-        if min_y == "unset" or y < min_y:
-            min_y = y
-    if min_x == "unset" or max_x == "unset" or min_y == "unset" or max_y =="unset":
+def series_window(xs, summary, x_range):
+    # Index bounds of the points inside x_range; only sorted series can be cut by bisection.
+    lo, hi = 0, len(xs)
+    if x_range and summary['sorted']:
+        if x_range[0] is not None:
+            lo = bisect_left(xs, x_range[0])
+        if x_range[1] is not None:
+            hi = bisect_right(xs, x_range[1])
+    return lo, hi
+
+
+def in_range(x, x_range):
+    return (x_range[0] is None or x >= x_range[0]) and (x_range[1] is None or x <= x_range[1])
+
+
+def window_points(xs, ys, summary, x_range=None):
+    lo, hi = series_window(xs, summary, x_range)
+    xs = xs[lo:hi]
+    ys = ys[lo:hi]
+    if (x_range and not summary['sorted']) or math.isnan(sum(xs)) or math.isnan(sum(ys)):
+        points = [(x, y) for x, y in zip(xs, ys)
+                  if not math.isnan(x) and not math.isnan(y) and (not x_range or in_range(x, x_range))]
+        xs = array('d', [p[0] for p in points])
+        ys = array('d', [p[1] for p in points])
+    return xs, ys
+
+
+PLOT_CELLS = bytes.maketrans(bytes([0, 1, 2]), b' xX')
+
+class PlotGrid:
+    # Points per plot cell ("x" for one, "X" for more), so --watch can add and
+    # remove single points. add() and remove() return False when the bounds
+    # have to move, the grid then needs a fill() with the new window.
+    def __init__(self, width=66, height=11, x_range=None):
+        self.width = width
+        self.height = height
+        self.x_range = x_range
+        self.bounds = None
+        self.cells = array('I', [0]) * (width*height)
+
+    def fill(self, xs, ys, bounds=None):
+        # xs, ys as returned by window_points()
+        if bounds is None and len(xs):
+            bounds = (min(xs), max(xs), min(ys), max(ys))
+        self.bounds = bounds
+        self.cells = cells = array('I', [0]) * (self.width*self.height)
+        if bounds is None:
+            return
+        col = self.width
+        row = self.height
+        min_x, max_x, min_y, max_y = bounds
+        # a flat axis puts everything on the first column / bottom row
+        range_x = (max_x - min_x) or 1.0
+        range_y = (max_y - min_y) or 1.0
+        for x, y in zip(xs, ys):
+            cells[int((row-1)-((y-min_y)/range_y)*(row-1))*col + int(((x-min_x)/range_x)*(col-1))] += 1
+
+    def cell(self, x, y):
+        min_x, max_x, min_y, max_y = self.bounds
+        range_x = (max_x - min_x) or 1.0
+        range_y = (max_y - min_y) or 1.0
+        return int((self.height-1)-((y-min_y)/range_y)*(self.height-1))*self.width + int(((x-min_x)/range_x)*(self.width-1))
+
+    def plotted(self, x, y):
+        return not math.isnan(x) and not math.isnan(y) and (not self.x_range or in_range(x, self.x_range))
+
+    def add(self, x, y):
+        if not self.plotted(x, y):
+            return True
+        if self.bounds is None:
+            return False
+        min_x, max_x, min_y, max_y = self.bounds
+        if not (min_x <= x <= max_x and min_y <= y <= max_y):
+            return False
+        self.cells[self.cell(x, y)] += 1
+        return True
+
+    def remove(self, x, y):
+        if not self.plotted(x, y):
+            return True
+        if x in self.bounds[:2] or y in self.bounds[2:]:
+            return False
+        self.cells[self.cell(x, y)] -= 1
+        return True
+
+    def lines(self, title):
+        if self.bounds is None:
+            return ["Could not plot data.."]
+        min_x, max_x, min_y, max_y = self.bounds
+        col = self.width
+        row = self.height
+        lines = [f'           {title}', f'{"": >10} ^']
+        for y in range(row):
+            r = bytes(min(n, 2) for n in self.cells[y*col:(y+1)*col]).translate(PLOT_CELLS).decode()
+            if y % 2 == 0:
+                yvalue = f'{max_y - y*(max_y-min_y)/(row-1):.3f}'
+                lines.append(f'{yvalue: >10} +' + r)
+            else:
+                lines.append(f'{"": >10} |' + r)
+        lr = f'{" ": >10}  '
+        for x in range(col):
+            if x % 13 == 0:
+                lr += "+"
+            else:
+                lr += "-"
+        lr += ">"
+        lines.append(lr)
+        lr = f'{" ": >4}  '
+        for x in range(int((col+12)/13)):
+            xvalue = min_x + x*13*(max_x-min_x)/(col-1)
+            if xvalue > 1700000000: # assume epoc
+                xvalue = datetime.fromtimestamp(int(xvalue)).strftime('%m-%d %H:%M')
+                lr += f'{xvalue: ^13}'
+            else:
+                xvalue = f'{xvalue:.3f}'
+                lr += f'{xvalue: ^13}'
+        lines.append(lr)
+        return lines
+
+
+def plot_graph_data(graphs, status, width=66, height=11, x_range=None, view=None):
+    view = view or series_view(graphs, status['selected'])
+    summary = view['summary']
+    xs, ys = window_points(view['xs'], view['ys'], summary, x_range)
+    if len(xs) == 0:
         print("Could not plot data..")
         return False
-    col = 66
-    row = 11
-    scaled_data = {}
-    print(f'           {gp[0]} {gp[1]} on {gp[2]}')
-    print(f'{"": >10} ^')
-    for p in data:
-        sx = int(((p[0]-min_x)/(max_x-min_x))*(col-1))
-        sy = int((row-1)-((p[1]-min_y)/(max_y-min_y))*(row-1))
-        if sy not in scaled_data.keys():
-            scaled_data[sy] = []
-        scaled_data[sy].append(sx)
-    for y in range(row):
-        r = []
-        for x in range(col):
-            r.append(" ")
-        if y in scaled_data.keys():
-            for sx in scaled_data[y]:
-                if sx < len(r):
-                    if r[sx] == " ":
-                        r[sx] = "x"
-                    else:
-                        r[sx] = "X"
-        if y % 2 == 0:
-            yvalue = f'{max_y - y*(max_y-min_y)/(row-1):.3f}'
-            print(f'{yvalue: >10} +' + "".join(r))
+    if not x_range:
+        min_x, max_x = summary['min_x'], summary['max_x']
+        min_y, max_y = summary['min_y'], summary['max_y']
+    else:
+        if summary['sorted']:
+            min_x, max_x = xs[0], xs[-1]
+        else:
+            min_x, max_x = min(xs), max(xs)
+        min_y, max_y = min(ys), max(ys)
+    grid = PlotGrid(width, height, x_range)
+    grid.fill(xs, ys, (min_x, max_x, min_y, max_y))
+    sys.stdout.write("\n".join(grid.lines(view["title"])) + "\n")
+    return True
+
+
+class SeriesWatch:
+    # --watch keeps one series in memory. Ops other runs append to its token's
+    # journal are applied one by one; any other change to the token (compaction,
+    # checkouts, --layout) reloads it and only the points after the part that
+    # stayed the same are taken out of and put into the plot grid.
+    def __init__(self, graphs, selected, x_range=None, size=None):
+        self.graphs = graphs
+        self.selected = selected
+        self.t, self.g, self.c = selected.split(".")
+        self.x_range = x_range
+        self.grid = PlotGrid(*size, x_range) if size else None
+        self.view = None
+        self.load()
+        if self.view is not None and self.grid:
+            self.fill()
+
+    def load(self):
+        graphs = self.graphs
+        graphs.refresh()
+        graphs.forget(self.t)
+        self.view = None
+        if self.t not in graphs.files:
+            return
+        found = self.c in graphs.index.tree.get(self.t, {}).get(self.g, {})
+        # the view and the journal offset it was replayed up to are read under
+        # the lock writers take, so no op lands between the two
+        with graphs.lock(self.t):
+            if found:
+                view = series_view(graphs, self.selected)
+            journal = graphs.journal_file(self.t)
+            self.offset = os.path.getsize(journal) if journal and os.path.exists(journal) else 0
+            self.stamp = token_stat(graphs.files[self.t])
+        if not found:
+            return
+        points = view['points'].copy()
+        self.view = dict(view, points=points, xs=points.xs, ys=points.ys, summary=dict(view['summary']))
+
+    def fill(self):
+        self.grid.fill(*window_points(self.view['xs'], self.view['ys'], self.view['summary'], self.x_range))
+
+    def update(self):
+        # True if the series may look different now
+        journal = self.graphs.journal_file(self.t)
+        try:
+            stamp = token_stat(self.graphs.files[self.t])
+        except (KeyError, OSError):
+            stamp = None
+        size = os.path.getsize(journal) if journal and os.path.exists(journal) else 0
+        if stamp != self.stamp or size < self.offset:
+            return self.reload()
+        if size == self.offset:
+            return False
+        with open(journal, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        # a line still being written is picked up on the next change
+        lines = chunk.split(b'\n')[:-1]
+        self.offset += sum(len(line) + 1 for line in lines)
+        changed = False
+        for line in lines:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                # a damaged line, the replay on reload skips it
+                return self.reload()
+            if op.get('g') == self.g and op.get('c') == self.c:
+                self.apply(op)
+                changed = True
+        return changed
+
+    def apply(self, op):
+        xs, ys = self.view['xs'], self.view['ys']
+        placed = True
+        if op['op'] == 'remove' and self.grid:
+            placed = self.grid.remove(xs[op['i']], ys[op['i']])
+        apply_series_op(xs, ys, self.view['summary'], op, self.view['points'])
+        if self.grid and op['op'] != 'remove':
+            i = op['i'] if op['op'] == 'insert' else len(xs) - 1
+            placed = self.grid.add(xs[i], ys[i])
+        if not placed:
+            self.fill()
+
+    def reload(self):
+        old = self.view
+        self.load()
+        if self.view is None or not self.grid:
+            return True
+        xs, ys = self.view['xs'], self.view['ys']
+        same = min(common_prefix(old['xs'], xs), common_prefix(old['ys'], ys))
+        placed = all(self.grid.remove(x, y) for x, y in zip(old['xs'][same:], old['ys'][same:]))
+        if placed:
+            placed = all(self.grid.add(x, y) for x, y in zip(xs[same:], ys[same:]))
+        if not placed:
+            self.fill()
+        return True
+
+    def paths(self):
+        # directories whose entries change when the series does
+        file = self.graphs.files.get(self.t, f'{self.graphs.dp}/{self.t}.json')
+        paths = [self.graphs.dp]
+        if token_layout(file) == 'segments':
+            paths += [file, f'{file}/{self.g}/{self.c}']
+        if self.graphs.journal_path:
+            paths.append(self.graphs.journal_path if os.path.isdir(self.graphs.journal_path)
+                         else os.path.dirname(self.graphs.journal_path))
+        return [path for path in paths if os.path.isdir(path)]
+
+    def frame(self, data=None):
+        lines = []
+        if data is not None:
+            lines += data_lines(self.view, self.x_range, *data)
+        if self.grid:
+            lines += self.grid.lines(self.view['title'])
+        return "\n".join(lines) + "\n"
+
+
+def common_prefix(a, b):
+    # number of leading values two float64 columns share, compared bitwise
+    a = memoryview(a).cast('B')
+    b = memoryview(b).cast('B')
+    lo, hi = 0, min(len(a), len(b)) // 8
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid*8] == b[:mid*8]:
+            lo = mid
         else:
-            print(f'{"": >10} |' + "".join(r))
-    lr = f'{" ": >10}  '
-    for x in range(col):
-        if x % 13 == 0:
-            lr += "+"
+            hi = mid - 1
+    return lo
+
+
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x40, 0x80, 0x100, 0x200
+
+def start_inotify():
+    # Linux only; None makes wait_for_change poll every WATCH_POLL seconds instead.
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return libc, fd
+
+
+def wait_for_change(inotify, paths):
+    if inotify is None:
+        time.sleep(WATCH_POLL)
+        return
+    libc, fd = inotify
+    for path in paths:
+        # adding a directory again just returns its existing watch
+        libc.inotify_add_watch(fd, os.fsencode(path),
+                               IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    select.select([fd], [], [], 60)
+    # writes come in bursts (journal line, cache, index), take them as one change
+    time.sleep(0.05)
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def watch_graph(graphs, selected, x_range=None, data=None, size=None):
+    # Redraws -d (data: rows, head, tail) and/or -p (size) whenever their output changes, until Ctrl-C.
+    watch = SeriesWatch(graphs, selected, x_range, size)
+    if watch.view is None:
+        print(f'{selected} does not exist anymore')
+        return False
+    last = watch.frame(data)
+    inotify = start_inotify()
+    try:
+        while True:
+            wait_for_change(inotify, watch.paths())
+            if not watch.update():
+                continue
+            if watch.view is None:
+                print(f'{selected} does not exist anymore')
+                return False
+            frame = watch.frame(data)
+            if frame != last:
+                if sys.stdout.isatty():
+                    sys.stdout.write("\x1b[H\x1b[2J")
+                sys.stdout.write(frame)
+                sys.stdout.flush()
+                last = frame
+    except KeyboardInterrupt:
+        return True
+    finally:
+        if inotify:
+            os.close(inotify[1])
+
+
+def parse_x_range(bounds):
+    x_range = []
+    for bound in bounds:
+        if bound == '-':
+            x_range.append(None)
+        elif bound.lower() == 'now':
+            x_range.append(time.time())
         else:
-            lr += "-"
-    lr += ">"
-    print(lr)
-    lr = f'{" ": >4}  '
-    for x in range(int((col+12)/13)):
-        xvalue = min_x + x*13*(max_x-min_x)/(col-1)
-        if xvalue > 1700000000: # assume epoc
-            xvalue = datetime.fromtimestamp(int(xvalue)).strftime('%m-%d %H:%M')
-            lr += f'{xvalue: ^13}'
+            x_range.append(parse_value(bound))
+            if x_range[-1] is None:
+                print(f'Could not parse range bound {bound}')
+                print(f'Please use number, timestamp ({TIME_FORMAT}), "NOW" or "-" for an open end')
+                return None
+    return tuple(x_range)
+
+
+BUCKETS = {'hour': 3600, 'day': 86400}
+# part of the combined cache keys, bumped when resampling changes
+COMBINED_VERSION = 2
+
+def expand_graphs(graphs, identifiers):
+    # TOKEN and TOKEN.GRAPH name all of their chains, anything else goes through find_graph.
+    index = graphs.index
+    series = []
+    for identifier in identifiers:
+        found = index.lookup(identifier)
+        if found and found.count(".") == 0:
+            series += [f'{found}.{g}.{c}' for g in index.tree[found].keys() for c in index.tree[found][g].keys()]
+        elif found and found.count(".") == 1:
+            t, g = found.split(".")
+            series += [f'{t}.{g}.{c}' for c in index.tree[t][g].keys()]
+        elif find_graph(graphs, identifier):
+            series.append(find_graph(graphs, identifier))
         else:
-            xvalue = f'{xvalue:.3f}'
-            lr += f'{xvalue: ^13}'
-    print(lr)
-    return True
+            print(f'Could not find graph {identifier}')
+            return None
+    return list(dict.fromkeys(series))
+
+
+def resample_series(xs, ys, summary, interval):
+    # Mean y per bucket; each bucket is cut out of the x-sorted columns with one
+    # bisection and summed as a slice. Buckets follow local time like TIME_FORMAT.
+    xs, ys = window_points(xs, ys, summary)
+    if not summary['sorted']:
+        order = sorted(range(len(xs)), key=xs.__getitem__)
+        xs = array('d', [xs[i] for i in order])
+        ys = array('d', [ys[i] for i in order])
+    buckets = {}
+    lo = 0
+    while lo < len(xs):
+        start, end = bucket_bounds(xs[lo], interval)
+        hi = bisect_left(xs, end, lo)
+        buckets[start] = sum(ys[lo:hi]) / (hi - lo)
+        lo = hi
+    return buckets
+
+
+def bucket_bounds(x, interval):
+    # Days run from one local midnight to the next, 23 or 25 hours on DST changes.
+    if interval == BUCKETS['day']:
+        midnight = datetime.fromtimestamp(x).replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight.timestamp(), (midnight + timedelta(days=1)).timestamp()
+    offset = time.localtime(x).tm_gmtoff
+    start = math.floor((x + offset) / interval) * interval - offset
+    return start, start + interval
+
+
+def combine_series(graphs, op, series, bucket):
+    # Results are kept in pUD_cache/combined under a key that includes every
+    # involved token's file stamp, so any change to the data is a miss.
+    tokens = sorted({s.split(".")[0] for s in series})
+    key = json.dumps([COMBINED_VERSION, op, bucket, series, [graphs.stamp(t) for t in tokens]])
+    name = f'{op} of {", ".join(series)} per {bucket}'
+    cache_file = None
+    if graphs.cache is not None:
+        cache_file = f'{graphs.cache.path}/combined/{hashlib.sha1(key.encode()).hexdigest()}.f64'
+    columns = array('d')
+    cached = cache_file is not None and os.path.exists(cache_file)
+    if cached:
+        with open(cache_file, 'rb') as f:
+            columns.frombytes(f.read())
+    else:
+        resampled = []
+        for s in series:
+            gp = s.split(".")
+            summary = graphs.series_summary(gp[0], gp[1], gp[2])
+            if not summary['x_is_date']:
+                print(f'{s} does not have timestamps on the X axis, it can not be resampled')
+                return None, False
+            resampled.append(resample_series(*graphs.series_numbers(gp[0], gp[1], gp[2]), summary, BUCKETS[bucket]))
+        xs = array('d', sorted(set().union(*resampled)))
+        if op == 'diff':
+            xs = array('d', [x for x in xs if x in resampled[0] and x in resampled[1]])
+            ys = array('d', [resampled[0][x] - resampled[1][x] for x in xs])
+        else:
+            ys = array('d')
+            for x in xs:
+                values = [r[x] for r in resampled if x in r]
+                ys.append(sum(values) / len(values) if op == 'avg' else sum(values))
+        columns = xs + ys
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            try:
+                saved = sorted(os.scandir(os.path.dirname(cache_file)), key=lambda e: e.stat().st_mtime)
+                for old in saved[:-31]:
+                    os.remove(old.path)
+            except FileNotFoundError:
+                # another run is pruning at the same time
+                pass
+            with open(f'{cache_file}.{os.getpid()}.tmp', 'wb') as f:
+                columns.tofile(f)
+            os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+    count = len(columns) // 2
+    xs, ys = columns[:count], columns[count:]
+    points = Series.from_columns(xs, ys, (KIND_TIME, KIND_FLOAT))
+    return {'name': name, 'title': name, 'points': points, 'xs': xs, 'ys': ys,
+            'summary': summarize_series(points, xs, ys, []), 'errors': []}, cached
+
+
+def export_series(graphs, series, x_range=None):
+    # One token's cache columns are mapped at a time and let go again, so memory
+    # stays flat however many graphs are exported.
+    token, numbers, summaries = None, None, None
+    for name in series:
+        t, key = name.split(".", 1)
+        if t != token:
+            token = t
+            numbers, summaries = graphs.token_columns(t)
+        yield (name, *window_points(*numbers[key], summaries[key], x_range))
+
+
+def export_rows(series):
+    for name, xs, ys in series:
+        for x, y in zip(xs, ys):
+            yield name, x, y
+
+
+EXPORT_MAGIC = b'pUDexport1\n'
+
+def write_export(out, fmt, series):
+    # bin: EXPORT_MAGIC, then per graph a little-endian uint16 name length, uint64
+    # point count, the UTF-8 name, count float64 x values and count float64 y values.
+    counts = {'series': 0, 'rows': 0}
+    def counted(series):
+        for name, xs, ys in series:
+            counts['series'] += 1
+            counts['rows'] += len(xs)
+            yield name, xs, ys
+    if fmt == 'csv':
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(['series', 'x', 'y'])
+        writer.writerows(export_rows(counted(series)))
+    elif fmt == 'ndjson':
+        for name, xs, ys in counted(series):
+            out.write("".join(json.dumps({'series': name, 'x': x, 'y': y}) + "\n" for x, y in zip(xs, ys)))
+    else:
+        out.write(EXPORT_MAGIC)
+        for name, xs, ys in counted(series):
+            encoded = name.encode()
+            out.write(struct.pack('<HQ', len(encoded), len(xs)) + encoded)
+            for column in (xs, ys):
+                if sys.byteorder != 'little':
+                    column = array('d', column)
+                    column.byteswap()
+                out.write(memoryview(column).cast('B'))
+    return counts
+
+
+def read_export(f):
+    # Reads what write_export(fmt='bin') wrote, one (name, xs, ys) per graph.
+    if f.read(len(EXPORT_MAGIC)) != EXPORT_MAGIC:
+        raise ValueError('not a plsUpdateData export')
+    while True:
+        header = f.read(10)
+        if not header:
+            return
+        length, count = struct.unpack('<HQ', header)
+        name = f.read(length).decode()
+        columns = []
+        for _ in range(2):
+            column = array('d')
+            column.frombytes(f.read(8 * count))
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+        yield name, *columns
+
+
+def export_graphs(graphs, fmt, over, x_range, out_file):
+    series = graphs.index.entries
+    if over:
+        series = expand_graphs(graphs, over)
+        if series is None:
+            return False, {}
+    series = export_series(graphs, series, x_range)
+    if out_file:
+        with open(out_file, 'wb' if fmt == 'bin' else 'w', newline='' if fmt != 'bin' else None) as f:
+            counts = write_export(f, fmt, series)
+        print(f'Exported {counts["rows"]} datapoint(s) of {counts["series"]} graph(s) to {out_file}')
+    else:
+        try:
+            counts = write_export(sys.stdout.buffer if fmt == 'bin' else sys.stdout, fmt, series)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # the reader is gone (| head), leave without a traceback
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return True, {}
+    return True, counts
+
+
+def plot_size(value):
+    try:
+        width, height = [int(v) for v in value.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'plot size "{value}" should look like WIDTHxHEIGHT')
+    if width < 2 or height < 2:
+        raise argparse.ArgumentTypeError('plot size must be at least 2x2')
+    return width, height
+
+
+def row_count(value):
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{value}" is not a number of datapoints')
+    if count < 0:
+        raise argparse.ArgumentTypeError('the number of datapoints can not be negative')
+    return count
 
 
 def datapoint_to_numbers(datapoint):
@@ -458,72 +2590,225 @@ def string_number_to_number(n):
     return n
 
 def datapoint_value_to_number(dpv):
-    if isinstance(dpv, str):
-        if is_int(dpv):
-            return float(dpv)
-        if is_float(dpv):
-            return float(dpv)
-        if is_timestamp(dpv):
-            return datetime.strptime(dpv, TIME_FORMAT).timestamp()
-    if isinstance(dpv, int):
-        return float(dpv)
+    n = parse_value(dpv)
+    if n is None:
+        return "ERROR"
+    return n
+
+
+_day_timestamps = {}
+
+def timestamp_to_number(n):
+    # Fast path for the fixed TIME_FORMAT layout: local midnight is resolved
+    # once per day and the time of day added on top. Days with a DST switch
+    # go through strptime.
+    if len(n) == 19 and n[4] == '-' and n[7] == '-' and n[10] == ' ' and n[13] == ':' and n[16] == ':':
+        day = _day_timestamps.get(n[:10])
+        if day is None:
+            midnight = datetime.strptime(n[:10], "%Y-%m-%d")
+            day = midnight.timestamp()
+            if (midnight + timedelta(days=1)).timestamp() - day != 86400:
+                day = False
+            _day_timestamps[n[:10]] = day
+        hms = n[11:13] + n[14:16] + n[17:19]
+        if day is not False and hms.isascii() and hms.isdigit():
+            hours = int(hms[0:2])
+            minutes = int(hms[2:4])
+            seconds = int(hms[4:6])
+            if hours < 24 and minutes < 60 and seconds < 60:
+                return day + hours*3600 + minutes*60 + seconds
+    return datetime.strptime(n, TIME_FORMAT).timestamp()
+
+
+def parse_value(dpv):
     if isinstance(dpv, float):
         return dpv
-    return "ERROR"
+    if isinstance(dpv, int):
+        return float(dpv)
+    if isinstance(dpv, str):
+        if len(dpv) == 19 and dpv[4] == '-':
+            try:
+                return timestamp_to_number(dpv)
+            except ValueError:
+                pass
+        try:
+            return float(dpv)
+        except ValueError:
+            pass
+        try:
+            return timestamp_to_number(dpv)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_values(values, axis='x', errors=None):
+    # Whole columns of plain numbers or number strings convert in one call,
+    # mixed columns fall back to classifying value by value.
+    try:
+        return array('d', values)
+    except TypeError:
+        pass
+    try:
+        return array('d', map(float, values))
+    except (TypeError, ValueError):
+        pass
+    numbers = array('d')
+    for i, v in enumerate(values):
+        n = parse_value(v)
+        if n is None:
+            n = math.nan
+            if errors is not None:
+                errors.append({'index': i, 'axis': axis, 'value': v})
+        numbers.append(n)
+    return numbers
+
+_git_state = {}
+
+def run_git(status, *args, capture=False):
+    return subprocess.run(['git', '-C', status['datapath'], *args],
+                          stdout=subprocess.PIPE if capture else subprocess.DEVNULL, text=True)
+
+
+def git_state(status):
+    # One porcelain query per invocation, dropped again whenever we write to the checkout.
+    if not _git_state:
+        out = run_git(status, 'status', '--porcelain=v2', '--branch', '--untracked-files=all', capture=True)
+        if out.returncode != 0:
+            raise subprocess.CalledProcessError(out.returncode, 'git status')
+        _git_state.update({'upstream': False, 'ahead': 0, 'behind': 0, 'changed': [], 'outside': []})
+        for line in out.stdout.splitlines():
+            if line.startswith('# branch.upstream '):
+                _git_state['upstream'] = True
+            elif line.startswith('# branch.ab '):
+                ahead, behind = line.split(' ')[2:4]
+                _git_state['ahead'] = int(ahead)
+                _git_state['behind'] = -int(behind)
+            elif line[:2] in ('1 ', '2 ', 'u ', '? '):
+                if line[0] == '1':
+                    path = line.split(' ', 8)[8]
+                elif line[0] == '2':
+                    path = line.split(' ', 9)[9].split('\t')[0]
+                elif line[0] == 'u':
+                    path = line.split(' ', 10)[10]
+                else:
+                    path = line[2:]
+                # paths are relative to the datapath, anything else starts with ../
+                _git_state['outside' if path.startswith('../') else 'changed'].append(path)
+    return _git_state
+
+
+def invalidate_git_state():
+    _git_state.clear()
+
+
+def changed_token_files(status):
+    return [path for path in git_state(status)['changed'] if path.endswith(('.json', '.jsonl'))]
+
 
 def fetch_updates(status, force=False):
-    cwd = os.getcwd()
-    os.chdir(status['datapath'])
-    output = subprocess.check_output(['git', 'status', '.'])
-    if 'nothing to commit' in str(output) or force:
-        if status['last_update'] + 600 <= time.time() or force:
-            out = subprocess.run(['git', 'checkout', "."], stdout=open(os.devnull, 'wb'))
+    # Pending journals are local changes too: they keep auto updates off like
+    # edited files do, and a forced update drops them with those edits.
+    if status['last_update'] + 600 <= time.time() or force:
+        journals = pending_journals()
+        if not (git_state(status)['changed'] or journals) or force:
+            out = run_git(status, 'checkout', '.')
+            invalidate_git_state()
             if out.returncode != 0:
-                os.chdir(cwd)
                 print('Failed to update graphs! Please fix.')
                 return False, True
+            for journal in journals:
+                with file_lock(journal[:-len(".jsonl")] + ".lock"):
+                    if os.path.exists(journal):
+                        os.remove(journal)
+            if journals:
+                print(f'Dropped the unsaved datapoints of {", ".join(os.path.basename(j)[:-6] for j in journals)}')
             set_status(status, 'last_update', time.time())
-            os.chdir(cwd)
             return True, True
-    os.chdir(cwd)
     return True, False
 
 
+def pending_journals():
+    path = os.path.dirname(os.path.realpath(__file__)) + "/pUD_journal"
+    if not os.path.isdir(path):
+        return []
+    return sorted(f'{path}/{name}' for name in os.listdir(path) if name.endswith(".jsonl"))
+
+
+def start_background_update(status):
+    # Claim the update window and let a detached worker run fetch_updates;
+    # it reports back through pUD_update_result.json on the next run.
+    set_status(status, 'last_update', time.time())
+    subprocess.Popen([sys.executable, os.path.realpath(__file__), '--background-update'],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def background_update():
+    path = os.path.dirname(os.path.realpath(__file__))
+    lock = path+"/pUD_update.lock"
+    if os.path.exists(lock) and os.path.getmtime(lock) + 300 < time.time():
+        # left behind by a worker that was killed
+        os.remove(lock)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        status = {'datapath': path + "/data/" + DATAPATH, 'last_update': 0}
+        try:
+            success, updated = fetch_updates(status)
+        except (OSError, subprocess.SubprocessError):
+            success, updated = False, False
+        write_atomic(path+"/pUD_update_result.json", json.dumps(
+            {'success': success, 'updated': updated, 'last_update': status['last_update'], 'timestamp': time.time()}))
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+def wait_for_background_update(timeout=30):
+    path = os.path.dirname(os.path.realpath(__file__))
+    deadline = time.time() + timeout
+    while os.path.exists(path+"/pUD_update.lock") and time.time() < deadline:
+        time.sleep(0.05)
+
+
 def check_git_status(status):
-    cwd = os.getcwd()
-    os.chdir(status['datapath'])
-    output = subprocess.check_output(['git', 'status' , '--', "':!.'"])
-    os.chdir(cwd)
-    if 'nothing to commit' not in str(output):
-        return False
-    return True
+    return not git_state(status)['outside']
+
+
+def commit_token_files(status, files):
+    wait_for_background_update()
+    run_git(status, 'add', '--', *files)
+    out = run_git(status, 'commit', '-m', 'pUD: Update graph values.')
+    invalidate_git_state()
+    return out.returncode == 0
+
 
 def commit_changes(status):
-    cwd = os.getcwd()
-    os.chdir(status['datapath'])
-    output = subprocess.check_output(['git', 'status', '.'])
-    if 'nothing to commit' in str(output):
-        os.chdir(cwd)
+    files = changed_token_files(status)
+    if not files:
         print('You have no changes to commit...')
         return True, False
-    subprocess.run(['git', 'add' , '.'], stdout=open(os.devnull, 'wb'))
-    subprocess.run(['git', 'commit', '-m' 'pUD: Update graph values.'], stdout=open(os.devnull, 'wb'))
-    os.chdir(cwd)
+    if not commit_token_files(status, files):
+        print('Failed to commit changes! Please fix.')
+        return False, False
     return True, True
 
 
 def push_changes(status):
-    cwd = os.getcwd()
-    os.chdir(status['datapath'])
-    output = subprocess.check_output(['git', 'status', '.'])
-    commited = 'nothing to commit' not in str(output)
+    files = changed_token_files(status)
+    commited = len(files) > 0
     if commited:
         print('Commiting unsaved changes before push..')
-        subprocess.run(['git', 'add' , '.'], stdout=open(os.devnull, 'wb'))
-        subprocess.run(['git', 'commit', '-m' 'pUD: Update graph values.'], stdout=open(os.devnull, 'wb'))
-    if 'Your branch is ahead' in str(output) or commited:
-        out = subprocess.run(['git', 'push'], stdout=open(os.devnull, 'wb'))
-        os.chdir(cwd)
+        if not commit_token_files(status, files):
+            print('Failed to commit changes! Please fix.')
+            return False, False, False
+    if git_state(status)['ahead'] > 0 or commited:
+        out = run_git(status, 'push')
+        invalidate_git_state()
         if out.returncode != 0:
             print("Failed to push changes! please fix")
             return False, False, commited
@@ -532,37 +2817,148 @@ def push_changes(status):
         return True, False, commited
     return True, True, commited
 
-def main(args, status):
+def main(args, status, graphs=None):
     if not status:
         return 1
-    ret = do_actions(args, status)
-    clear_crash_rep(status)
+    if args.profile is not None and not _profile['enabled']:
+        start_profile()
+    try:
+        ret = do_actions(args, status, graphs)
+        clear_crash_rep(status)
+    finally:
+        start_phase('save-status')
+        save_status(status)
+        end_phase()
+        if _profile['enabled']:
+            print_profile(args.profile)
+            _profile['enabled'] = False
     return ret
 
 
-def do_actions(args, status):
+BATCH_VERBS = {'select': '-s', 'add': '-a', 'add-from': '--add-from', 'remove': '-r', 'ordered': '--ordered',
+               'show': '-d', 'plot': '-p', 'commit': '--commit', 'push': '--push'}
+
+def read_batch(source):
+    if source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source) as f:
+            lines = f.read().splitlines()
+    ops = []
+    for lineno, line in enumerate(lines, 1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            print(f'line {lineno}: {e}')
+            return None
+        if not words:
+            continue
+        words[0] = BATCH_VERBS.get(words[0], words[0])
+        try:
+            with redirect_stderr(sys.stdout):
+                line_args = read_args(['-u', 'd'] + words)
+        except SystemExit:
+            print(f'line {lineno}: could not read "{line.strip()}"')
+            return None
+        # every line gets -u d in front, one that asks for another update overrides it
+        if (line_args.batch or line_args.daemon or line_args.background_update or line_args.cache or line_args.layout
+                or line_args.sparse_add or line_args.watch or line_args.update[0] != 'd'):
+            print(f'line {lineno}: --batch, --daemon, --cache, --layout, --sparse-add, --watch and updates can not be used inside a batch')
+            return None
+        if line_args.add and (line_args.add[1].lower() == 'now' or is_timestamp(line_args.add[1])):
+            # add would ask whether that was meant, and a batch has no one to answer
+            print(f'line {lineno}: time value {line_args.add[1]!r} on Y axis')
+            return None
+        ops.append((lineno, line.strip(), line_args))
+    return ops
+
+
+def run_batch(graphs, args, status):
+    # Every line runs through do_actions on the same status and graphs. Writes are
+    # held back until the end, commit/push are left to the outer do_actions.
+    ops = read_batch(args.batch)
+    if ops is None:
+        return False, []
+    results = []
+    history = status['action_history']
+    graphs.defer()
+    try:
+        for lineno, line, line_args in ops:
+            args.commit = args.commit or line_args.commit
+            args.push = args.push or line_args.push
+            line_args.commit = line_args.push = line_args.compact = False
+            status['action_history'] = []
+            code = do_actions(line_args, status, graphs, batch=True)
+            results.append({'line': lineno, 'op': line, 'success': code == 0, 'actions': status['action_history'][::-1]})
+            if code != 0:
+                print(f'Batch stopped at line {lineno}: {line}')
+                return False, results
+    finally:
+        status['action_history'] = history
+        set_pending_action(status, 'batch-flush')
+        conflicts = graphs.flush()
+        if conflicts:
+            # only adds can be put on top of what another run wrote in the meantime
+            print(f'{", ".join(conflicts)} changed while the batch ran, its changes to them were not written')
+    return not conflicts, results
+
+
+def do_actions(args, status, graphs=None, batch=False):
+    if batch:
+        # run_batch already did the update, git and loading steps once for the whole batch
+        return do_graph_actions(args, status, graphs)
     if args.update:
         if args.update[0] == 'a' or args.update[0] == 'auto':
-            set_pending_action(status, 'update', args.update)
-            success, updated = fetch_updates(status)
-            if updated or not success:
-                add_action_history(status, "update", success, {'arg': 'auto', 'updated': updated})
-            if not success:
-                return 1
+            if status['last_update'] + 600 <= time.time():
+                set_pending_action(status, 'update', args.update)
+                start_background_update(status)
         if args.update[0] == 'f' or args.update[0] == 'force':
             set_pending_action(status, 'update', args.update)
             success, updated = fetch_updates(status, True)
             add_action_history(status, "update", success, {'arg': 'force', 'updated': updated})
             if not success:
                 return 1
-    if args.add or args.remove or args.commit or args.push:
+    if args.add or args.add_from or args.remove or args.ordered == 'on' or args.batch or args.commit or args.push:
         set_pending_action(status, 'check-git-status')
         if not check_git_status(status):
             print('You have unsaved changes in your local repository, please commit or stash them before updating data..')
             return 1
 
+    if args.sparse_add:
+        set_pending_action(status, 'sparse-add', args.sparse_add)
+        success = sparse_add(status, args.sparse_add)
+        add_action_history(status, "sparse-add", success, {'tokens': args.sparse_add})
+        if not success:
+            return 1
+        print(f'Checked out {", ".join(args.sparse_add)}')
+
     set_pending_action(status, 'get-graphs')
-    graphs = get_graphs(status['datapath'])
+    if graphs is None:
+        graphs = get_graphs(status['datapath'], args.workers)
+    else:
+        graphs.refresh()
+        graphs.workers = args.workers or os.cpu_count() or 1
+    if args.batch:
+        set_pending_action(status, 'batch', args.batch)
+        success, results = run_batch(graphs, args, status)
+        add_action_history(status, "batch", success, {'source': args.batch, 'lines': results[-100:]})
+        if not success:
+            return 1
+    return do_graph_actions(args, status, graphs)
+
+
+def do_graph_actions(args, status, graphs):
+    if args.cache:
+        set_pending_action(status, 'cache', args.cache)
+        if args.cache == 'rebuild':
+            graphs.cache.rebuild(graphs)
+            add_action_history(status, "cache", True, {'arg': 'rebuild'})
+        graphs.cache.print_stats(graphs)
+    if args.layout:
+        set_pending_action(status, 'layout', args.layout)
+        converted = [t for t in list(graphs.keys()) if graphs.convert(t, args.layout)]
+        add_action_history(status, "layout", True, {'layout': args.layout, 'tokens': len(converted)})
+        print(f'Converted {len(converted)} of {len(graphs)} tokens to the {args.layout} layout')
     if args.list_info:
         set_pending_action(status, 'list-info')
         list_graphs(graphs, status['selected'], True)
@@ -592,40 +2988,99 @@ def do_actions(args, status):
                 print(f'Selected: {" > ".join(status["selected"].split("."))}')
             else:
                 return 1
-    if args.add or args.remove or args.data or args.plot:
+    x_range = None
+    if args.x_range:
+        x_range = parse_x_range(args.x_range)
+        if x_range is None:
+            return 1
+    needs_selection = args.combine and not args.over or (args.data or args.plot) and not args.combine
+    if args.add or args.remove or args.ordered or needs_selection:
         if status['selected'] == '':
             print('You must select a graph first...')
             return 1
+    if args.ordered:
+        set_pending_action(status, 'ordered', args.ordered)
+        success = set_ordered(graphs, args.ordered == 'on', status)
+        add_action_history(status, "ordered", success, {'arg': args.ordered, 'selected': status['selected']})
+        if not success:
+            return 1
     if args.add:
         to = []
         if args.to:
             to = args.to
         set_pending_action(status, 'add', args.add + to)
-        success = add_to_data(args.add, args.to, status)
+        success = add_to_data(graphs, args.add, args.to, status)
         add_action_history(status, "add", success, {'coords': args.add, 'to': args.to, 'selected': status['selected']})
         if not success:
             return 1
-        set_pending_action(status, 'get-graphs')
-        graphs = get_graphs(status['datapath'])
     elif args.to:
         print('--to only works with --add')
         return 1
+    if args.add_from:
+        set_pending_action(status, 'add-from', args.add_from)
+        success, added = add_from_file(graphs, args.add_from, status)
+        add_action_history(status, "add-from", success, {'source': args.add_from, 'added': added})
+        if not success:
+            return 1
     if args.remove:
         set_pending_action(status, 'remove', args.remove)
-        success = remove_from_data(args.remove[0], status)
+        success = remove_from_data(graphs, args.remove[0], status)
         add_action_history(status, "remove", success, {'index': args.remove[0], 'selected': status['selected']})
         if not success:
             return 1
-        set_pending_action(status, 'get-graphs')
-        graphs = get_graphs(status['datapath'])
+    view = None
+    if args.combine:
+        set_pending_action(status, 'combine', args.combine)
+        over = expand_graphs(graphs, args.over or [status['selected'].rsplit(".", 1)[0]])
+        if over is None:
+            return 1
+        if args.combine == 'diff' and len(over) != 2:
+            print(f'diff needs exactly two graphs, got {len(over)}: {", ".join(over)}')
+            return 1
+        view, cached = combine_series(graphs, args.combine, over, args.bucket)
+        add_action_history(status, "combine", view is not None, {'op': args.combine, 'over': over,
+                           'bucket': args.bucket, 'cached': cached})
+        if view is None:
+            return 1
+        if not args.plot:
+            args.data = True
+    elif args.over and not args.export:
+        print('--over only works with --combine or --export')
+        return 1
     if args.data:
         set_pending_action(status, 'list-data')
-        success = show_graph_data(graphs, status)
-        add_action_history(status, "list-data", success, {'selected': status['selected']})
+        success = show_graph_data(graphs, status, x_range, args.rows, args.head, args.tail, view)
+        add_action_history(status, "list-data", success, {'selected': view['name'] if view else status['selected'],
+                           'parse_errors': len(view['errors'] if view else graphs.series_errors(*status['selected'].split(".")))})
     if args.plot:
         set_pending_action(status, 'plot')
-        success = plot_graph_data(graphs, status)
-        add_action_history(status, "plot", success, {'selected': status['selected']})
+        success = plot_graph_data(graphs, status, *args.size, x_range, view)
+        add_action_history(status, "plot", success, {'selected': view['name'] if view else status['selected'],
+                           'parse_errors': len(view['errors'] if view else graphs.series_errors(*status['selected'].split(".")))})
+    if args.watch:
+        if view is not None or not (args.data or args.plot):
+            print('--watch only works with -d or -p on the selected graph')
+            return 1
+        set_pending_action(status, 'watch')
+        success = watch_graph(graphs, status['selected'], x_range, (args.rows, args.head, args.tail) if args.data else None,
+                              args.size if args.plot else None)
+        add_action_history(status, "watch", success, {'selected': status['selected']})
+        if not success:
+            return 1
+    if args.export:
+        set_pending_action(status, 'export', args.export)
+        success, counts = export_graphs(graphs, args.export, args.over, x_range, args.out)
+        add_action_history(status, "export", success, {'format': args.export, 'over': args.over, 'out': args.out, **counts})
+        if not success:
+            return 1
+    elif args.out:
+        print('--out only works with --export')
+        return 1
+    if args.compact or args.commit or args.push:
+        set_pending_action(status, 'compact')
+        compacted = graphs.compact()
+        if compacted:
+            add_action_history(status, "compact", True, {'tokens': compacted})
     if args.commit:
         set_pending_action(status, 'commit')
         success, commited = commit_changes(status)
@@ -644,6 +3099,133 @@ def do_actions(args, status):
 
 
 
+class NeedsTerminal(Exception):
+    pass
+
+
+def needs_terminal(prompt=''):
+    raise NeedsTerminal(prompt)
+
+
+def daemon_socket():
+    return os.path.dirname(os.path.realpath(__file__)) + "/pUD_daemon.sock"
+
+
+def read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def daemon_request(request):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(daemon_socket()):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(daemon_socket())
+            sock.sendall(json.dumps(request).encode())
+            sock.shutdown(socket.SHUT_WR)
+            return json.loads(read_all(sock))
+    except (OSError, ValueError):
+        return None
+
+
+def run_daemon(command):
+    if command == 'stop':
+        if daemon_request({'stop': True}) is None:
+            print('No daemon running.')
+            return 1
+        print('Daemon stopped.')
+        return 0
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Daemon mode needs unix sockets.')
+        return 1
+    if os.path.exists(daemon_socket()):
+        if daemon_request({'ping': True}) is not None:
+            print('Daemon is already running.')
+            return 1
+        os.remove(daemon_socket())
+    state = {'status': read_status()}
+    if not state['status']:
+        return 1
+    state['graphs'] = get_graphs(state['status']['datapath'])
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(daemon_socket())
+    server.listen()
+    print(f'Listening on {daemon_socket()}')
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    request = json.loads(read_all(conn))
+                    if request.get('stop'):
+                        conn.sendall(json.dumps({'output': '', 'code': 0}).encode())
+                        return 0
+                    response = {'output': '', 'code': 0}
+                    if 'argv' in request:
+                        response = handle_daemon_request(request, state)
+                    conn.sendall(json.dumps(response).encode())
+                except (ValueError, OSError) as e:
+                    # a truncated request or a client that went away, only that request is dropped
+                    print(f'Dropped a request: {e}')
+    finally:
+        server.close()
+        os.remove(daemon_socket())
+
+
+def handle_daemon_request(request, state):
+    options = {arg.split("=")[0] for arg in request['argv']}
+    if '--watch' in options:
+        # runs until interrupted, that has to happen in the caller's terminal
+        return {'fallback': True}
+    if '--export' in options and '--out' not in options:
+        # streamed to the caller's stdout, bin needs its byte stream and big exports would pile up here
+        return {'fallback': True}
+    path = os.path.dirname(os.path.realpath(__file__))
+    with open(path+"/pUD_status.json") as f:
+        on_disk = f.read()
+    if on_disk != _status_on_disk.get('content') or os.path.exists(path+"/pUD_update_result.json"):
+        state['status'] = read_status()
+    invalidate_git_state()
+    out = io.StringIO()
+    cwd = os.getcwd()
+    argv, stdin, prompt = sys.argv, sys.stdin, builtins.input
+    sys.argv = [sys.argv[0]] + request['argv']
+    sys.stdin = io.StringIO(request.get('stdin', ''))
+    builtins.input = needs_terminal
+    try:
+        os.chdir(request['cwd'])
+        with redirect_stdout(out), redirect_stderr(out):
+            try:
+                code = main(read_args(request['argv']), state['status'], state['graphs'])
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except NeedsTerminal:
+        # prompts need the caller's terminal, the client reruns the call in-process
+        state['graphs'] = get_graphs(state['status']['datapath'])
+        return {'fallback': True}
+    except Exception:
+        state['graphs'] = get_graphs(state['status']['datapath'])
+        out.write(traceback.format_exc())
+        code = 1
+    finally:
+        os.chdir(cwd)
+        sys.argv, sys.stdin, builtins.input = argv, stdin, prompt
+    return {'output': out.getvalue(), 'code': code}
+
+
 if __name__ == '__main__':
-    main(read_args(), read_status())
+    args = read_args()
+    if args.background_update:
+        background_update()
+    elif args.daemon:
+        sys.exit(run_daemon(args.daemon))
+    else:
+        if args.profile is not None:
+            start_profile()
+        sys.exit(main(args, read_status(args)))
 